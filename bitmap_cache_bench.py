@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import sys
+import json
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import importlib.util
+
+from bitmap_cache_parser import BMCContainer, BMCStats
+from bitmap_cache_synth import b_synth_corpus
+
+# name -> (BMCContainer options, stream the tiles through iter_tiles instead of b_process)
+CONFIGS = {
+    "process": ({}, False),
+    "stream": ({}, True),
+    "mmap": ({"use_mmap": True}, True),
+    "decode-workers": ({"workers": min(4, os.cpu_count() or 1)}, True),
+    "writers": ({"writers": 2}, True),
+    "zip": ({"fmt": "zip"}, True),
+    "tar": ({"fmt": "tar"}, True),
+}
+
+def b_load_reference(fname):
+    """Load a reference implementation of BMCContainer from a Python file (e.g. an older revision)"""
+    spec = importlib.util.spec_from_file_location("bitmap_cache_reference", fname)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.BMCContainer
+
+def b_run(container, src, dname, stream):
+    """Import, decode and export src with container into the empty folder dname"""
+    if not container.b_import(src):
+        return False
+    try:
+        if stream:
+            container.b_export(dname, container.iter_tiles())
+        else:
+            container.b_process()
+            container.b_export(dname)
+    finally:
+        container.b_flush()
+    return True
+
+def b_outputs(dname):
+    """name -> content of every bitmap written to dname, archive members included"""
+    outputs = {}
+    for name in os.listdir(dname):
+        path = os.path.join(dname, name)
+        if name.endswith(".zip"):
+            with zipfile.ZipFile(path) as z:
+                for member in z.namelist():
+                    outputs[member] = z.read(member)
+        elif name.endswith(".tar"):
+            with tarfile.open(path) as t:
+                for member in t.getmembers():
+                    outputs[member.name] = t.extractfile(member).read()
+        else:
+            with open(path, "rb") as f:
+                outputs[name] = f.read()
+    return outputs
+
+def b_compare(expected, dname):
+    """Names of the bitmaps which are missing, extra or different in dname"""
+    outputs = b_outputs(dname)
+    return sorted(name for name in set(expected) | set(outputs) if expected.get(name) != outputs.get(name))
+
+def b_bench(files, configs, repeat=3, width=64, reference=None, log=print):
+    """Time every config on every file (best of repeat runs), checking the outputs against reference
+
+    Each run exports the tiles, their old data and the collage. Returns one
+    result dict per (config, file) with the best BMCStats report and the
+    outcome of the equivalence check (None without reference or when the
+    reference itself fails on the file).
+    """
+    results = []
+    tmp = tempfile.mkdtemp(prefix="bmc_bench_")
+    try:
+        for src in files:
+            expected = None
+            if reference:
+                ref_dir = os.path.join(tmp, "reference")
+                os.makedirs(ref_dir)
+                try:
+                    b_run(reference(old=True, big=True, width=width, log_callback=lambda msg: None), src, ref_dir, False)
+                    expected = b_outputs(ref_dir)
+                except Exception as e:
+                    log(f"[---] Reference failed on '{src}': {e!r}; not comparing.")
+                shutil.rmtree(ref_dir)
+            for name in configs:
+                options, stream = CONFIGS[name]
+                best = None
+                mismatches = None
+                for i in range(repeat):
+                    out_dir = os.path.join(tmp, name)
+                    os.makedirs(out_dir)
+                    stats = BMCStats()
+                    bmcc = BMCContainer(old=True, big=True, width=width, log_callback=lambda msg: None, stats=stats, **options)
+                    b_run(bmcc, src, out_dir, stream)
+                    report = stats.b_report(src, bmcc.ntiles, os.path.getsize(src))
+                    if best is None or report["wall"] < best["wall"]:
+                        best = report
+                    if i == 0 and expected is not None:
+                        mismatches = b_compare(expected, out_dir)
+                    shutil.rmtree(out_dir)
+                results.append({"config": name, "file": src, "report": best,
+                                "equivalent": None if mismatches is None else len(mismatches) == 0, "mismatches": (mismatches or [])[:10]})
+                eq = {None: "", True: "  identical", False: f"  DIFFERS ({len(mismatches)} files)"}[results[-1]["equivalent"]]
+                log(f"{name:<15} {os.path.basename(src):<16} {best['tiles']:>6} tiles {best['wall']:>8.3f}s "
+                    f"{best['tiles_per_sec']:>9.1f} tiles/s {best['bytes_per_sec']/(1<<20):>7.2f} MiB/s{eq}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="RDP Bitmap Cache parser benchmark suite.")
+    parser.add_argument("-s", "--src", help="Cache file or directory to benchmark (default: a synthetic corpus).")
+    parser.add_argument("-n", "--tiles", type=int, default=500, help="Tiles per synthetic container (default=500).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpus (default=0).")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per measurement, the best one is kept (default=3).")
+    parser.add_argument("-w", "--width", type=int, default=64, help="Collage width in tiles (default=64).")
+    parser.add_argument("-c", "--config", action="append", choices=list(CONFIGS), help="Configuration to run (repeatable; default=all).")
+    parser.add_argument("--reference", help="Python file with the reference BMCContainer to check the outputs against.")
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    corpus = None
+    if args.src:
+        from bitmap_cache_parser import b_find_files
+        files = b_find_files(args.src)
+    else:
+        corpus = tempfile.mkdtemp(prefix="bmc_corpus_")
+        files = b_synth_corpus(corpus, args.tiles, seed=args.seed)
+    reference = b_load_reference(args.reference) if args.reference else None
+    try:
+        results = b_bench(sorted(files), args.config or list(CONFIGS), max(1, args.repeat), args.width, reference)
+    finally:
+        if corpus:
+            shutil.rmtree(corpus, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    return 1 if any(res["equivalent"] is False for res in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import re
+import json
+import mmap
+import time
+from struct import unpack_from
+
+from bitmap_cache_parser import BMCContainer
+
+# Width and height (1..64), t_len (at most a 64x64x4 slot) and t_params
+# (flags in the low byte) of a BMC tile header, as accepted by
+# b_bmc_plausible. The match starts 9 bytes in, at the high byte of the
+# width: a leading character class would slow the search down several times,
+# so the low byte of the width is checked afterwards
+BMC_TILE_HEADER = re.compile(rb"\x00[\x01-\x40]\x00..\x00\x00.\x00\x00\x00", re.S)
+BMC_HEADER_SIZE = BMCContainer.TILE_HEADER_SIZE[BMCContainer.BMC_CONTAINER]
+BIN_HEADER_SIZE = BMCContainer.TILE_HEADER_SIZE[BMCContainer.BIN_CONTAINER]
+# Data slot sizes of the BMC tiles (1 to 4 bytes per pixel); compressed 24-bit caches do not exist
+BMC_SLOTS = [64*64*cf for cf in [1, 2, 3, 4]]
+# The data slot size of compressed tiles is told by the file name, see BMCContainer.b_walk_headers
+COMPRESSED_NAMES = {64*64: "bcache2", 64*64*2: "bcache22", 64*64*4: "bcache24"}
+
+def b_bmc_plausible(data, off, bl):
+    """Tell whether a sane BMC tile header with a data slot of bl bytes sits at off"""
+    if off < 0 or off+BMC_HEADER_SIZE+bl > len(data):
+        return False
+    t_width, t_height, t_len, t_params = unpack_from("<HHLL", data, off+8)
+    if not (0 < t_width <= 64 and 0 < t_height <= 64) or t_params > 0xFF:
+        return False
+    if t_params & 0x08:
+        return bl in COMPRESSED_NAMES and 0 < t_len <= bl
+    return t_len == bl//(64*64)*t_width*t_height
+
+def b_bmc_run(data, off, min_tiles):
+    """Longest run of BMC tiles through the header at off: (start, end, bl, tiles, compressed), or None if shorter than min_tiles"""
+    best = None
+    for bl in BMC_SLOTS:
+        if not b_bmc_plausible(data, off, bl):
+            continue
+        # Every tile of a cache file has the same slot size, so the run has a fixed stride
+        stride = BMC_HEADER_SIZE+bl
+        first = last = off
+        while b_bmc_plausible(data, first-stride, bl):
+            first -= stride
+        while b_bmc_plausible(data, last+stride, bl):
+            last += stride
+        n = (last-first)//stride+1
+        if n >= min_tiles and (best is None or n > best[3]):
+            compressed = any(data[p+16] & 0x08 for p in range(first, last+stride, stride))
+            best = (first, last+stride, bl, n, compressed)
+    return best
+
+def b_bin_run(data, off):
+    """Extent of the BIN container whose file header is at off: (start, end, tiles)"""
+    p = off+len(BMCContainer.BIN_FILE_HEADER)+4
+    n = 0
+    while p+BIN_HEADER_SIZE <= len(data):
+        t_width, t_height = unpack_from("<HH", data, p+8)
+        end = p+BIN_HEADER_SIZE+4*t_width*t_height
+        if not (0 < t_width <= 64 and 0 < t_height <= 64) or end > len(data):
+            break
+        p = end
+        n += 1
+    return off, p, n
+
+def b_carve_chunk(fname, start, end, min_tiles):
+    """Scan the container headers starting in bytes start..end-1 of fname, returning their runs
+
+    Runs are (start, end, kind, bl, tiles, compressed) tuples; they may reach
+    out of the chunk, so the same run can be reported by neighbouring chunks.
+    """
+    with open(fname, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        runs = []
+        sig = BMCContainer.BIN_FILE_HEADER
+        p = data.find(sig, start, min(end+len(sig)-1, len(data)))
+        while p >= 0:
+            first, last, n = b_bin_run(data, p)
+            if n > 0:
+                runs.append((first, last, "bin", 0, n, False))
+            p = data.find(sig, p+1, min(end+len(sig)-1, len(data)))
+        covered = 0
+        for m in BMC_TILE_HEADER.finditer(data, start+9, min(end+BMC_HEADER_SIZE, len(data))):
+            off = m.start()-9
+            if off < covered or not 0 < data[off+8] <= 64:
+                continue
+            run = b_bmc_run(data, off, min_tiles)
+            if run is not None:
+                first, last, bl, n, compressed = run
+                runs.append((first, last, "bmc", bl, n, compressed))
+                covered = last
+        return runs
+    finally:
+        data.close()
+
+class BMCCarver():
+    """Recover RDP bitmap cache containers from a raw disk image, unallocated space or a memory dump
+
+    The image is memory-mapped and scanned in CHUNK-sized pieces, on a
+    process pool with workers > 1, for the RDP8bmp file header of BIN
+    containers and for runs of at least min_tiles sane BMC tile headers at a
+    fixed stride. Each recovered run is then handed as a zero-copy view to
+    a BMCContainer, as if it were a cache file of its own.
+    """
+    CHUNK = 64 << 20
+    MIN_TILES = 4
+    MANIFEST = "carved_containers.json"
+
+    def __init__(self, fname, workers=1, min_tiles=MIN_TILES, log_callback=None):
+        self.fname = fname
+        self.workers = workers
+        self.min_tiles = min_tiles
+        self.log_callback = log_callback or print
+        self.runs = []
+
+    def b_log(self, ltype, lmsg):
+        self.log_callback(f"{BMCContainer.LOG_TYPES[ltype]} {lmsg}")
+
+    def b_scan(self):
+        """Find the container runs of the image into self.runs, in image order"""
+        size = os.path.getsize(self.fname)
+        t0 = time.perf_counter()
+        chunks = [(start, min(start+self.CHUNK, size)) for start in range(0, size, self.CHUNK)]
+        runs = set()
+        if self.workers > 1 and len(chunks) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=self.workers) as ex:
+                for found in ex.map(b_carve_chunk, [self.fname]*len(chunks), *zip(*chunks), [self.min_tiles]*len(chunks)):
+                    runs.update(found)
+        else:
+            for start, end in chunks:
+                runs.update(b_carve_chunk(self.fname, start, end, self.min_tiles))
+        # A run found inside another one (e.g. header-like bytes in its pixel data) is left out
+        self.runs = []
+        for run in sorted(runs, key=lambda r: (r[0], -r[1])):
+            if self.runs and run[1] <= self.runs[-1][1]:
+                continue
+            self.runs.append(run)
+        wall = time.perf_counter()-t0
+        self.b_log(0, f"{len(self.runs)} container(s) found in {size} bytes in {wall:.2f}s ({size/(1<<20)/max(wall, 1e-9):.1f} MiB/s).")
+        return self.runs
+
+    def b_name(self, run):
+        """File name standing for a carved container, telling its offset in the image and its colour depth"""
+        start, end, kind, bl, n, compressed = run
+        base = f"{os.path.basename(self.fname)}@{start:012x}"
+        if kind == "bin":
+            return base+".bin"
+        if compressed:
+            # The parser needs the usual name to size the data slots of compressed tiles
+            return f"{base}_{COMPRESSED_NAMES[bl]}.bmc"
+        return f"{base}_bcache_{8*bl//(64*64)}bpp.bmc"
+
+    def b_export(self, dname, options=None):
+        """Decode and export every carved container to dname, recording them in the MANIFEST file there"""
+        # Worker processes re-open the cache file by name, which a carved container does not have
+        options = dict(options or {}, workers=1)
+        records = []
+        if not self.runs:
+            return records
+        with open(self.fname, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(data)
+        try:
+            for run in self.runs:
+                start, end, kind, bl, n, compressed = run
+                name = self.b_name(run)
+                self.b_log(1, f"Carved {kind.upper()} container at offset 0x{start:x} ({end-start} bytes, {n} tile headers): '{name}'.")
+                bmcc = BMCContainer(log_callback=self.log_callback, **options)
+                ok = False
+                try:
+                    if bmcc.b_import_data(view[start:end], name):
+                        ok = bmcc.b_export(dname, bmcc.iter_tiles()) and bmcc.b_ok
+                finally:
+                    bmcc.b_flush()
+                records.append({"name": name, "kind": kind, "offset": start, "size": end-start, "tiles": bmcc.ntiles, "ok": ok})
+        finally:
+            view.release()
+            data.close()
+        with open(os.path.join(dname, self.MANIFEST), "w") as f:
+            json.dump({"image": os.path.abspath(self.fname), "containers": records}, f, indent=1)
+        self.b_log(0, f"{sum(r['tiles'] for r in records)} tiles recovered from {len(records)} carved container(s).")
+        return records
+
+def b_carve(fname, dname, options=None, workers=1, log_callback=None, min_tiles=BMCCarver.MIN_TILES):
+    """Carve the cache containers out of the raw image fname and export their tiles to dname"""
+    carver = BMCCarver(fname, workers, min_tiles, log_callback)
+    carver.b_scan()
+    return carver.b_export(dname, options)
@@ -0,0 +1,1817 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import sys
+import mmap
+from struct import Struct, pack, unpack_from
+from array import array
+import time
+import hashlib
+import io
+import json
+import tarfile
+import tempfile
+import threading
+import zipfile
+from collections import deque, namedtuple
+from itertools import chain, islice
+from queue import Queue
+
+# Seconds between two saves of the batch manifests (see b_batch)
+MANIFEST_SAVE_INTERVAL = 30.0
+
+# concurrent.futures and multiprocessing are only imported by the parallel
+# code paths, to keep the start-up of the command-line front end short
+
+# One decoded tile as yielded by BMCContainer.iter_tiles(); pfmt is the pixel
+# format of data and old_data (0 = exported 32-bit pixels, see BMCContainer.b_convert)
+BMCTile = namedtuple("BMCTile", ["index", "key1", "key2", "width", "height", "data", "old_data", "pfmt"], defaults=[0])
+# One tile header as found by BMCContainer.b_walk_headers(); bl is the size of its data slot
+BMCEntry = namedtuple("BMCEntry", ["offset", "key1", "key2", "width", "height", "t_len", "t_params", "bl"])
+
+def b_unrle_entry(x):
+    """Decode table entry for order header byte x: (cmd, rl, sz, ext)
+
+    cmd is the command class (-1 for invalid orders, with the offending byte
+    in sz), rl the run length or its base and sz the header size. ext tells
+    how the run length is extended: 0 = fixed, 1 = next byte added to rl,
+    2 = 16-bit little-endian run length in the next two bytes.
+    """
+    if (x&0xF0) == 0xF0:
+        if x in [0xF5, 0xFB, 0xFC, 0xFF]:
+            return (-1, 2, x, 0)
+        elif x in [0xFD, 0xFE]:
+            return (x, 0, 1, 0)
+        elif x in [0xF9, 0xFA]:
+            return (x, 8, 1, 0)
+        return (x, 0, 3, 2)
+    elif (x&0xE0) == 0xA0:
+        return (-1, 2, x, 0)
+    if (x&0x80) == 0x00 or (x&0xE0) == 0x80:
+        c = x&0x1F
+        x = x&0xE0
+        o = 32
+    else:
+        c = x&0x0F
+        x = x&0xF0
+        o = 16
+    if x in [0x40, 0xD0]:
+        c *= 8
+        o = 1
+    if c == 0:
+        return (x, o, 2, 1)
+    return (x, c, 1, 0)
+
+class BMCChunkReader(io.RawIOBase):
+    """Read-only file object over an iterable of byte chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.chunk) == 0:
+            self.chunk = next(self.chunks, None)
+            if self.chunk is None:
+                self.chunk = b""
+                return 0
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+class BMCDirSink():
+    """Default output: every bitmap is a file of its own in the destination folder"""
+    EXT = None
+
+    def __init__(self, dname, base=None):
+        self.path = dname
+
+    def b_write(self, name, data):
+        with open(os.path.join(self.path, name), "wb") as f:
+            f.write(data)
+        return True
+
+    def b_write_chunks(self, name, size, chunks):
+        """Write a bitmap of known size given as a stream of chunks"""
+        with open(os.path.join(self.path, name), "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return True
+
+    def b_close(self):
+        return True
+
+class BMCZipSink():
+    """All bitmaps of a container in one uncompressed zip archive, written sequentially"""
+    EXT = ".zip"
+
+    def __init__(self, dname, base):
+        self.path = os.path.join(dname, base+self.EXT)
+        self.f = open(self.path, "wb", buffering=1<<20)
+        self.zip = zipfile.ZipFile(self.f, "w", zipfile.ZIP_STORED)
+        self.lock = threading.Lock()
+
+    def b_write(self, name, data):
+        with self.lock:
+            self.zip.writestr(name, data)
+        return True
+
+    def b_write_chunks(self, name, size, chunks):
+        """Write a bitmap of known size given as a stream of chunks"""
+        # Same member attributes as writestr() gives
+        zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        zinfo.compress_type = self.zip.compression
+        zinfo.external_attr = 0o600<<16
+        zinfo.file_size = size
+        with self.lock, self.zip.open(zinfo, "w") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return True
+
+    def b_close(self):
+        self.zip.close()
+        self.f.close()
+        return True
+
+class BMCTarSink():
+    """All bitmaps of a container in one tar archive, written sequentially"""
+    EXT = ".tar"
+
+    def __init__(self, dname, base):
+        self.path = os.path.join(dname, base+self.EXT)
+        self.f = open(self.path, "wb", buffering=1<<20)
+        self.tar = tarfile.open(fileobj=self.f, mode="w", format=tarfile.PAX_FORMAT)
+        self.lock = threading.Lock()
+
+    def b_write(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        with self.lock:
+            self.tar.addfile(info, io.BytesIO(data))
+        return True
+
+    def b_write_chunks(self, name, size, chunks):
+        """Write a bitmap of known size given as a stream of chunks"""
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        with self.lock:
+            self.tar.addfile(info, io.BufferedReader(BMCChunkReader(chunks)))
+        return True
+
+    def b_close(self):
+        self.tar.close()
+        self.f.close()
+        return True
+
+class BMCWriter():
+    """Writer threads fed through a bounded queue, overlapping the output of tiles with their decoding
+
+    Jobs are argument tuples for write(); the queue depth bounds the number
+    of decoded tiles waiting for output. The first exception raised by a
+    writer is re-raised in the producer by the next b_put() or b_close().
+    """
+
+    def __init__(self, write, threads=1, depth=64):
+        self.queue = Queue(maxsize=depth)
+        self.error = None
+        self.threads = [threading.Thread(target=self.b_run, args=(write,), daemon=True) for _ in range(threads)]
+        for t in self.threads:
+            t.start()
+
+    def b_run(self, write):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.error is None:
+                try:
+                    write(*job)
+                except Exception as e:
+                    self.error = e
+
+    def b_put(self, *job):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(job)
+
+    def b_close(self):
+        """Wait until every queued job is written and stop the threads"""
+        if self.threads:
+            for _ in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.threads = []
+        if self.error is not None:
+            raise self.error
+        return True
+
+class BMCStats():
+    """Per-stage wall and CPU time of the processing of one cache file
+
+    A BMCContainer given a BMCStats instance routes its stages through
+    b_timed() wrappers, so runs without one pay nothing. The times of a
+    stage add up over all its calls and threads (CPU time is per thread);
+    the collage bands are built while they are written, so the collage
+    stage is part of the write stage, and stages run by decoding worker
+    processes are not measured. hook, if given, is called with the
+    b_report() dict of each file.
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def b_add(self, stage, wall, cpu, nbytes=0):
+        with self.lock:
+            st = self.stages.setdefault(stage, {"calls": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0})
+            st["calls"] += 1
+            st["wall"] += wall
+            st["cpu"] += cpu
+            st["bytes"] += nbytes
+        return True
+
+    def b_timed(self, stage, fn, nbytes=None):
+        """Wrap fn so that its calls are accounted to stage; nbytes(args, result) gives the bytes handled"""
+        def timed(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            res = fn(*args, **kwargs)
+            self.b_add(stage, time.perf_counter()-wall, time.thread_time()-cpu, nbytes(args, res) if nbytes else 0)
+            return res
+        return timed
+
+    def b_timed_iter(self, stage, fn):
+        """Wrap the generator function fn so that producing each item is accounted to stage"""
+        def timed(*args, **kwargs):
+            it = fn(*args, **kwargs)
+            while True:
+                wall, cpu = time.perf_counter(), time.thread_time()
+                item = next(it, None)
+                self.b_add(stage, time.perf_counter()-wall, time.thread_time()-cpu)
+                if item is None:
+                    return
+                yield item
+        return timed
+
+    def b_report(self, fname, tiles, nbytes):
+        """Machine-readable summary of the run so far, handed to the hook as well"""
+        wall = time.perf_counter()-self.wall
+        report = {
+            "file": fname,
+            "tiles": tiles,
+            "bytes": nbytes,
+            "wall": wall,
+            "cpu": time.process_time()-self.cpu,
+            "tiles_per_sec": tiles/wall if wall > 0 else 0.0,
+            "bytes_per_sec": nbytes/wall if wall > 0 else 0.0,
+            "peak_memory_kb": b_peak_memory(),
+            "stages": {stage: dict(st) for stage, st in self.stages.items()},
+        }
+        if self.hook:
+            self.hook(report)
+        return report
+
+class BMCTileStore():
+    """Decoded tiles kept in their native pixel format, packed into one contiguous buffer
+
+    Each tile is recorded as its number, cache keys, size, pixel format (see
+    BMCContainer.b_convert) and the offset and lengths of its data and old
+    data in the buffer, the old data length being -1 when there is none.
+    """
+    REC_SIZE = 8
+
+    def __init__(self):
+        self.data = bytearray()
+        self.recs = array("q")
+        self.pfmts = bytearray()
+
+    def __len__(self):
+        return len(self.pfmts)
+
+    def b_append(self, tile):
+        t_off = len(self.data)
+        self.data += tile.data
+        o_len = -1
+        if tile.old_data is not None:
+            o_len = len(tile.old_data)
+            self.data += tile.old_data
+        self.recs.extend((tile.index, tile.key1, tile.key2, tile.width, tile.height, t_off, len(tile.data), o_len))
+        self.pfmts.append(tile.pfmt)
+        return True
+
+    def b_get(self, i):
+        """Tile i as a BMCTile record in its native pixel format (old_data is None if absent)"""
+        index, key1, key2, width, height, t_off, t_len, o_len = self.recs[self.REC_SIZE*i:self.REC_SIZE*(i+1)]
+        o_bmp = None if o_len < 0 else bytes(self.data[t_off+t_len:t_off+t_len+o_len])
+        return BMCTile(index, key1, key2, width, height, bytes(self.data[t_off:t_off+t_len]), o_bmp, self.pfmts[i])
+
+class BMCContainer():
+    BIN_FILE_HEADER = b"RDP8bmp\x00"
+    BIN_CONTAINER = b".BIN"
+    BMC_CONTAINER = b".BMC"
+    TILE_HEADER_SIZE = {BMC_CONTAINER: 0x14, BIN_CONTAINER: 0xC}
+    STRIPE_WIDTH = 64
+    LOG_TYPES = ["[===]", "[+++]", "[---]", "[!!!]"]
+    INDEX_MAGIC = b"BMCIDX1\x00"
+    INDEX_RECORD = "<QLLHHLLL"
+    CHUNK_TILES = 64
+    # Output sinks selectable through fmt
+    SINKS = {"bmp": BMCDirSink, "zip": BMCZipSink, "tar": BMCTarSink}
+    
+    # Complete PALETTE definition from original code
+    PALETTE = bytes(bytearray((0, 0, 0, 0, 0, 0, 128, 0, 0, 128, 0, 0, 0, 128, 128, 0, 128, 0, 0, 0, 128, 0, 128, 0, 128, 128, 0, 0, 192, 192, 192, 0, 192, 220, 192, 0, 240, 202, 166, 0, 0, 32, 64, 0, 0, 32, 96, 0, 0, 32, 128, 0, 0, 32, 160, 0, 0, 32, 192, 0, 0, 32, 224, 0, 0, 64, 0, 0, 0, 64, 32, 0, 0, 64, 64, 0, 0, 64, 96, 0, 0, 64, 128, 0, 0, 64, 160, 0, 0, 64, 192, 0, 0, 64, 224, 0, 0, 96, 0, 0, 0, 96, 32, 0, 0, 96, 64, 0, 0, 96, 96, 0, 0, 96, 128, 0, 0, 96, 160, 0, 0, 96, 192, 0, 0, 96, 224, 0, 0, 128, 0, 0, 0, 128, 32, 0, 0, 128, 64, 0, 0, 128, 96, 0, 0, 128, 128, 0, 0, 128, 160, 0, 0, 128, 192, 0, 0, 128, 224, 0, 0, 160, 0, 0, 0, 160, 32, 0, 0, 160, 64, 0, 0, 160, 96, 0, 0, 160, 128, 0, 0, 160, 160, 0, 0, 160, 192, 0, 0, 160, 224, 0, 0, 192, 0, 0, 0, 192, 32, 0, 0, 192, 64, 0, 0, 192, 96, 0, 0, 192, 128, 0, 0, 192, 160, 0, 0, 192, 192, 0, 0, 192, 224, 0, 0, 224, 0, 0, 0, 224, 32, 0, 0, 224, 64, 0, 0, 224, 96, 0, 0, 224, 128, 0, 0, 224, 160, 0, 0, 224, 192, 0, 0, 224, 224, 0, 64, 0, 0, 0, 64, 0, 32, 0, 64, 0, 64, 0, 64, 0, 96, 0, 64, 0, 128, 0, 64, 0, 160, 0, 64, 0, 192, 0, 64, 0, 224, 0, 64, 32, 0, 0, 64, 32, 32, 0, 64, 32, 64, 0, 64, 32, 96, 0, 64, 32, 128, 0, 64, 32, 160, 0, 64, 32, 192, 0, 64, 32, 224, 0, 64, 64, 0, 0, 64, 64, 32, 0, 64, 64, 64, 0, 64, 64, 96, 0, 64, 64, 128, 0, 64, 64, 160, 0, 64, 64, 192, 0, 64, 64, 224, 0, 64, 96, 0, 0, 64, 96, 32, 0, 64, 96, 64, 0, 64, 96, 96, 0, 64, 96, 128, 0, 64, 96, 160, 0, 64, 96, 192, 0, 64, 96, 224, 0, 64, 128, 0, 0, 64, 128, 32, 0, 64, 128, 64, 0, 64, 128, 96, 0, 64, 128, 128, 0, 64, 128, 160, 0, 64, 128, 192, 0, 64, 128, 224, 0, 64, 160, 0, 0, 64, 160, 32, 0, 64, 160, 64, 0, 64, 160, 96, 0, 64, 160, 128, 0, 64, 160, 160, 0, 64, 160, 192, 0, 64, 160, 224, 0, 64, 192, 0, 0, 64, 192, 32, 0, 64, 192, 64, 0, 64, 192, 96, 0, 64, 192, 128, 0, 64, 192, 160, 0, 64, 192, 192, 0, 64, 192, 224, 0, 64, 224, 0, 0, 64, 224, 32, 0, 64, 224, 64, 0, 64, 224, 96, 0, 64, 224, 128, 0, 64, 224, 160, 0, 64, 224, 192, 0, 64, 224, 224, 0, 128, 0, 0, 0, 128, 0, 32, 0, 128, 0, 64, 0, 128, 0, 96, 0, 128, 0, 128, 0, 128, 0, 160, 0, 128, 0, 192, 0, 128, 0, 224, 0, 128, 32, 0, 0, 128, 32, 32, 0, 128, 32, 64, 0, 128, 32, 96, 0, 128, 32, 128, 0, 128, 32, 160, 0, 128, 32, 192, 0, 128, 32, 224, 0, 128, 64, 0, 0, 128, 64, 32, 0, 128, 64, 64, 0, 128, 64, 96, 0, 128, 64, 128, 0, 128, 64, 160, 0, 128, 64, 192, 0, 128, 64, 224, 0, 128, 96, 0, 0, 128, 96, 32, 0, 128, 96, 64, 0, 128, 96, 96, 0, 128, 96, 128, 0, 128, 96, 160, 0, 128, 96, 192, 0, 128, 96, 224, 0, 128, 128, 0, 0, 128, 128, 32, 0, 128, 128, 64, 0, 128, 128, 96, 0, 128, 128, 128, 0, 128, 128, 160, 0, 128, 128, 192, 0, 128, 128, 224, 0, 128, 160, 0, 0, 128, 160, 32, 0, 128, 160, 64, 0, 128, 160, 96, 0, 128, 160, 128, 0, 128, 160, 160, 0, 128, 160, 192, 0, 128, 160, 224, 0, 128, 192, 0, 0, 128, 192, 32, 0, 128, 192, 64, 0, 128, 192, 96, 0, 128, 192, 128, 0, 128, 192, 160, 0, 128, 192, 192, 0, 128, 192, 224, 0, 128, 224, 0, 0, 128, 224, 32, 0, 128, 224, 64, 0, 128, 224, 96, 0, 128, 224, 128, 0, 128, 224, 160, 0, 128, 224, 192, 0, 128, 224, 224, 0, 192, 0, 0, 0, 192, 0, 32, 0, 192, 0, 64, 0, 192, 0, 96, 0, 192, 0, 128, 0, 192, 0, 160, 0, 192, 0, 192, 0, 192, 0, 224, 0, 192, 32, 0, 0, 192, 32, 32, 0, 192, 32, 64, 0, 192, 32, 96, 0, 192, 32, 128, 0, 192, 32, 160, 0, 192, 32, 192, 0, 192, 32, 224, 0, 192, 64, 0, 0, 192, 64, 32, 0, 192, 64, 64, 0, 192, 64, 96, 0, 192, 64, 128, 0, 192, 64, 160, 0, 192, 64, 192, 0, 192, 64, 224, 0, 192, 96, 0, 0, 192, 96, 32, 0, 192, 96, 64, 0, 192, 96, 96, 0, 192, 96, 128, 0, 192, 96, 160, 0, 192, 96, 192, 0, 192, 96, 224, 0, 192, 128, 0, 0, 192, 128, 32, 0, 192, 128, 64, 0, 192, 128, 96, 0, 192, 128, 128, 0, 192, 128, 160, 0, 192, 128, 192, 0, 192, 128, 224, 0, 192, 160, 0, 0, 192, 160, 32, 0, 192, 160, 64, 0, 192, 160, 96, 0, 192, 160, 128, 0, 192, 160, 160, 0, 192, 160, 192, 0, 192, 160, 224, 0, 192, 192, 0, 0, 192, 192, 32, 0, 192, 192, 64, 0, 192, 192, 96, 0, 192, 192, 128, 0, 192, 192, 160, 0, 240, 251, 255, 0, 164, 160, 160, 0, 128, 128, 128, 0, 0, 0, 255, 0, 0, 255, 0, 0, 0, 255, 255, 0, 255, 0, 0, 0, 255, 0, 255, 0, 255, 255, 0, 0, 255, 255, 255, 0)))
+    
+    COLOR_BLACK = b"\x00"
+    COLOR_WHITE = b"\xFF"
+    
+    # RGB565 pixel value -> 4-byte output pixel, built on first use
+    RGB565_LUT = None
+    
+    # Colours listed by b_log_uniform, the others being summed up
+    UNIFORM_TOP = 8
+    
+    # Pixel format (see b_convert) -> bytes per native pixel
+    PIXEL_SIZE = {0: 4, 1: 1, 2: 2, 3: 3, 4: 4}
+    
+    # First order byte -> (cmd, rl, sz, ext), see b_unrle_entry
+    UNRLE_TABLE = tuple(b_unrle_entry(x) for x in range(256))
+    
+    def __init__(self, verbose=False, count=0, old=False, big=False, width=64, log_callback=None, use_mmap=False, workers=1, dedup=None, fmt="bmp", writers=0, stats=None, budget=None, deadline=None, skip_uniform=False, stitch=False, phash=False, keep_index=False):
+        self.bdat = b""
+        self.boff = 0
+        self.bstart = 0
+        self.bmap = None
+        self.tindex = []
+        # Save the tile index sidecar after a header scan, see b_index
+        self.keep_index = keep_index
+        self.use_mmap = use_mmap
+        self.workers = workers
+        self.dedup = dedup
+        self.fmt = fmt
+        self.writers = writers
+        self.stats = stats
+        self.budget = budget
+        self.deadline = deadline
+        self.coverage = None
+        self.skip_uniform = skip_uniform
+        self.uniform = {}
+        self.stitch = stitch
+        # (tile number, perceptual hash) of the exported tiles, see bitmap_cache_phash
+        self.phashes = [] if phash else None
+        self.ntiles = 0
+        self.store = BMCTileStore()
+        self.btype = None
+        self.cnt = count
+        self.fname = None
+        self.oldsave = old
+        self.pal = False
+        self.verb = verbose
+        self.big = big
+        self.STRIPE_WIDTH = width
+        self.log_callback = log_callback
+        self.b_ok = True
+        self.rle_handlers = {
+            0x00: self.b_rle_bg_run, 0xF0: self.b_rle_bg_run,
+            0x20: self.b_rle_fg_run, 0xF1: self.b_rle_fg_run,
+            0xC0: self.b_rle_set_fg_run, 0xF6: self.b_rle_set_fg_run,
+            0xE0: self.b_rle_dither_run, 0xF8: self.b_rle_dither_run,
+            0x60: self.b_rle_color_run, 0xF3: self.b_rle_color_run,
+            0x40: self.b_rle_mix_run, 0xF2: self.b_rle_mix_run,
+            0xD0: self.b_rle_set_mix_run, 0xF7: self.b_rle_set_mix_run,
+            0xF9: self.b_rle_mix_3, 0xFA: self.b_rle_mix_5,
+            0x80: self.b_rle_copy, 0xF4: self.b_rle_copy,
+            0xFD: self.b_rle_white, 0xFE: self.b_rle_black,
+        }
+        
+        if stats:
+            self.b_instrument(stats)
+        
+        if count > 0:
+            self.b_log(True, 2, "At most %d tiles will be processed.", count)
+        if old:
+            self.b_log(True, 2, "Old data will also be saved in separate files.")
+    
+    def b_instrument(self, stats):
+        """Account the costly stages to stats (the timed wrappers shadow the methods)"""
+        self.b_import = stats.b_timed("import", self.b_import, lambda args, res: len(self.bdat))
+        self.b_walk_headers = stats.b_timed_iter("walk", self.b_walk_headers)
+        self.b_uncompress = stats.b_timed("unrle", self.b_uncompress, lambda args, res: len(args[0]))
+        self.b_convert = stats.b_timed("convert", self.b_convert, lambda args, res: len(res))
+        self.b_export_bmp = stats.b_timed("encode", self.b_export_bmp, lambda args, res: len(res))
+        self.b_collage_bands = stats.b_timed_iter("collage", self.b_collage_bands)
+        return True
+
+    def b_log(self, verbose, ltype, lmsg, *args):
+        """Log lmsg; verbose messages only in verbose mode, args are %-formatted into lmsg only when it is emitted"""
+        if not verbose or self.verb:
+            self.b_emit(f"{self.LOG_TYPES[ltype]} {lmsg % args if args else lmsg}")
+        return True
+
+    def b_emit(self, log_message):
+        """Hand an already formatted log line to the callback or stdout"""
+        if self.log_callback:
+            self.log_callback(log_message)
+        else:
+            print(log_message)
+
+    def b_import(self, fname):
+        """Import BMCache file, either read in full or memory-mapped (use_mmap)"""
+        if len(self.bdat)-self.boff > 0:
+            self.b_log(False, 3, "Data is already waiting to be processed; aborting.")
+            return False
+        self.b_release()
+        
+        try:
+            with open(fname, "rb") as f:
+                if self.use_mmap and os.fstat(f.fileno()).st_size > 0:
+                    self.bmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    if hasattr(self.bmap, "madvise"):
+                        self.bmap.madvise(mmap.MADV_SEQUENTIAL)
+                    data = memoryview(self.bmap)
+                else:
+                    data = f.read()
+        except Exception as e:
+            self.b_log(False, 3, f"Unable to retrieve file contents; aborting. Error: {str(e)}")
+            return False
+        return self.b_import_data(data, fname)
+
+    def b_import_data(self, data, fname):
+        """Import BMCache data already in memory, e.g. a container carved out of a disk image; fname names it"""
+        self.bdat = data if isinstance(data, memoryview) else memoryview(data)
+        if len(self.bdat) == 0:
+            self.b_log(False, 3, "Unable to retrieve file contents; aborting.")
+            return False
+        
+        self.fname = fname
+        self.btype = self.BMC_CONTAINER
+        
+        if self.bdat[:len(self.BIN_FILE_HEADER)] == self.BIN_FILE_HEADER:
+            if self.verb:
+                self.b_log(True, 2, "Subsequent header version: %d.", unpack_from("<L", self.bdat, len(self.BIN_FILE_HEADER))[0])
+            self.boff = self.bstart = len(self.BIN_FILE_HEADER)+4
+            self.btype = self.BIN_CONTAINER
+        
+        self.b_log(True, 0, "Successfully loaded '%s' as a %s container.", self.fname, self.btype.decode())
+        return True
+
+    def b_process(self):
+        """Process the imported BMCache data, keeping every decoded tile in memory (self.store)"""
+        for tile in self.iter_tiles(native=True):
+            self.store.b_append(tile)
+        return self.b_ok
+
+    def iter_tiles(self, native=False):
+        """Decode the imported BMCache data one tile at a time, yielding BMCTile records
+
+        Only the tile being yielded is held in memory. With native, the pixel
+        data is left in its stored format, except for tiles decoded by worker
+        processes. Tiles are numbered in extraction order, as they always
+        were: discarded (empty) tiles take no number, unlike in the tile
+        index. With skip_uniform, blank and solid-colour tiles are only
+        counted in self.uniform (they keep their tile number). self.b_ok is
+        set to False when processing has to be aborted.
+        """
+        self.b_ok = True
+        if len(self.bdat)-self.boff <= 0:
+            self.b_log(False, 3, "Nothing to process.")
+            self.b_ok = False
+            return
+        
+        n = self.ntiles = 0
+        if self.workers > 1:
+            decoded = self.b_decode_parallel(self.boff)
+        else:
+            decoded = ((entry,)+self.b_decode_native(entry) for entry in self.b_walk_headers(self.boff))
+        try:
+            for entry, pfmt, t_bmp, o_bmp in decoded:
+                self.boff = entry.offset+self.TILE_HEADER_SIZE[self.btype]+entry.bl
+                # Palette tiles are never empty once converted
+                if len(t_bmp) > 0 or pfmt == 1:
+                    # Uniform tiles are told apart on their native pixels, before any conversion
+                    if self.skip_uniform and self.b_uniform_tile(pfmt, t_bmp, o_bmp):
+                        pass
+                    elif native or pfmt == 0:
+                        yield BMCTile(n, entry.key1, entry.key2, entry.width, entry.height, t_bmp, o_bmp, pfmt)
+                    else:
+                        o_bmp = self.b_convert(pfmt, o_bmp) if o_bmp is not None else b""
+                        yield BMCTile(n, entry.key1, entry.key2, entry.width, entry.height, self.b_convert(pfmt, t_bmp), o_bmp)
+                    n = self.ntiles = n+1
+                    if n%100 == 0:
+                        self.b_log(True, 1, "%d tiles successfully extracted so far.", n)
+                
+                if self.cnt != 0 and n == self.cnt:
+                    break
+        finally:
+            decoded.close()
+        
+        if self.b_ok:
+            self.b_log(False, 0, f"{n} tiles successfully extracted in the end.")
+        self.b_log_uniform()
+
+    def b_uniform_colour(self, pfmt, data):
+        """Colour ("#RRGGBB") of a tile whose pixels are all the same, else None"""
+        pal = len(self.PALETTE)
+        if pfmt == 0 and len(data) > pal and data[:pal] == self.PALETTE:
+            # Palette tile converted by a worker process: back to its indexes
+            pfmt, data = 1, data[pal:]
+        unit = self.PIXEL_SIZE[pfmt]
+        px = bytes(data[:unit])
+        if len(data) == 0 or len(data)%unit != 0 or px*(len(data)//unit) != data:
+            return None
+        if pfmt == 1:
+            bgr = self.PALETTE[4*px[0]:4*px[0]+3]
+        elif pfmt == 2:
+            bgr = self.b_parse_rgb565(px)[:3]
+        else:
+            bgr = px[:3]
+        return "#%02X%02X%02X" % (bgr[2], bgr[1], bgr[0])
+
+    def b_uniform_tile(self, pfmt, data, old_data=None):
+        """Tell whether a tile is to be skipped as uniform, counting it in self.uniform by colour
+
+        With oldsave, a tile is only skipped when its old data is empty or uniform too.
+        """
+        colour = self.b_uniform_colour(pfmt, data)
+        if colour is None:
+            return False
+        if self.oldsave and old_data and self.b_uniform_colour(pfmt, old_data) is None:
+            return False
+        self.uniform[colour] = self.uniform.get(colour, 0)+1
+        return True
+
+    def b_log_uniform(self):
+        """Summarise the uniform tiles skipped so far, listing the UNIFORM_TOP most frequent colours"""
+        if self.uniform:
+            counts = sorted(self.uniform.items(), key=lambda c: -c[1])
+            colours = [f"{c} x{k}" for c, k in counts[:self.UNIFORM_TOP]]
+            if len(counts) > self.UNIFORM_TOP:
+                rest = counts[self.UNIFORM_TOP:]
+                colours.append(f"{sum(k for c, k in rest)} in {len(rest)} other colours")
+            self.b_log(False, 0, "%d uniform tiles skipped: %s.", sum(self.uniform.values()), ", ".join(colours))
+        return True
+
+    def b_decode_parallel(self, off):
+        """Decode tiles from offset off on a process pool, yielding (entry, pfmt, data, old_data) in order (pfmt 0 from the workers)
+
+        Headers are walked and sent to the workers in chunks of CHUNK_TILES tiles; each worker
+        hands its decoded chunk back in one shared memory block. At most two
+        chunks per worker are in flight, so memory stays bounded. If the pool
+        fails, the tiles not handed out yet are decoded serially.
+        """
+        errors = []
+        entries = self.b_walk_headers(off, errors)
+        from concurrent.futures import ProcessPoolExecutor
+        pending = deque()
+        failed = None
+        try:
+            ex = ProcessPoolExecutor(max_workers=self.workers)
+        except Exception as e:
+            ex, failed = None, e
+        try:
+            while failed is None:
+                while len(pending) < 2*self.workers:
+                    chunk = list(islice(entries, self.CHUNK_TILES))
+                    if len(chunk) == 0:
+                        break
+                    try:
+                        fut = ex.submit(b_decode_chunk, self.fname, self.verb, chunk)
+                    except Exception as e:
+                        fut, failed = None, e
+                    pending.append((chunk, fut))
+                    if fut is None:
+                        break
+                if failed is not None or len(pending) == 0:
+                    break
+                chunk, fut = pending[0]
+                try:
+                    tiles, logs, pal = b_collect_chunk(fut.result())
+                except Exception as e:
+                    failed = e
+                    break
+                pending.popleft()
+                self.pal = self.pal or pal
+                for entry, (t_bmp, o_bmp), t_logs in zip(chunk, tiles, logs):
+                    for log_message in t_logs:
+                        self.b_emit(log_message)
+                    yield (entry, 0, t_bmp, o_bmp)
+        finally:
+            if ex is not None:
+                for chunk, fut in pending:
+                    if fut is not None:
+                        fut.cancel()
+                ex.shutdown(wait=True)
+                # Free the blocks of the chunks decoded but not handed out
+                for chunk, fut in pending:
+                    if fut is not None and not fut.cancelled() and fut.exception() is None:
+                        try:
+                            b_collect_chunk(fut.result())
+                        except Exception:
+                            pass
+        if failed is not None:
+            self.b_log(False, 2, f"Parallel decoding failed ({failed}); decoding the rest of the file serially.")
+            for entry in chain(chain.from_iterable(chunk for chunk, fut in pending), entries):
+                yield (entry,)+self.b_decode_native(entry)
+        # The walk runs ahead of decoding: only report its abort once every
+        # tile before it has been handed out
+        for lmsg in errors:
+            self.b_log(False, 3, lmsg)
+            self.b_ok = False
+
+    def b_walk_headers(self, off, errors=None):
+        """Walk the tile headers from offset off without decoding any pixel data
+
+        Yields one BMCEntry per tile; bl is the size of the tile's data slot.
+        self.b_ok is set to False when the walk has to be aborted, unless an
+        errors list is given: the abort message is then appended to it instead.
+        """
+        bdat = self.bdat
+        hs = self.TILE_HEADER_SIZE[self.btype]
+        bl = 0
+        while len(bdat)-off > 0:
+            if len(bdat)-off < hs:
+                self.b_walk_abort(errors, f"Truncated tile header ({len(bdat)-off} of {hs} bytes) found at the end of the data; aborting.")
+                return
+            p = off+hs
+            key1, key2, t_width, t_height = unpack_from("<LLHH", bdat, off)
+            t_len = t_params = 0
+            
+            if self.btype == self.BIN_CONTAINER:
+                bl = 4*t_width*t_height
+            elif self.btype == self.BMC_CONTAINER:
+                t_len, t_params = unpack_from("<LL", bdat, p-0x8)
+                if t_params & 0x08:  # Compression bit flag
+                    if bl == 0:
+                        if "22.bmc" in self.fname:
+                            bl = 64*64*2
+                        elif "24.bmc" in self.fname:
+                            bl = 64*64*4
+                        elif "2.bmc" in self.fname:
+                            bl = 64*64
+                        else:
+                            for b in [1, 2, 4]:
+                                if len(bdat) < p+64*64*b+8:
+                                    break
+                                elif unpack_from("<H", bdat, p+64*64*b+8)[0] == 64:
+                                    bl = 64*64*b
+                                    break
+                            if bl == 0:
+                                self.b_walk_abort(errors, "Unable to determine data pattern size; exiting before throwing any error!")
+                                return
+                else:
+                    cf = t_len//(t_width*t_height)
+                    if cf not in [1, 2, 3, 4]:
+                        self.b_walk_abort(errors, f"Unexpected bpp ({8*cf}) found during processing; aborting.")
+                        return
+                    bl = cf*64*64
+            
+            yield BMCEntry(off, key1, key2, t_width, t_height, t_len, t_params, bl)
+            off = p+bl
+
+    def b_walk_abort(self, errors, lmsg):
+        """Report why b_walk_headers stopped, or defer it to the errors list"""
+        if errors is None:
+            self.b_log(False, 3, lmsg)
+            self.b_ok = False
+        else:
+            errors.append(lmsg)
+        return True
+
+    def b_decode_entry(self, entry):
+        """Decode the tile described by a BMCEntry, returning (data, old_data)"""
+        pfmt, t_bmp, o_bmp = self.b_decode_native(entry)
+        return self.b_convert(pfmt, t_bmp), self.b_convert(pfmt, o_bmp) if o_bmp is not None else b""
+
+    def b_decode_native(self, entry):
+        """Decode the tile described by a BMCEntry without pixel conversion, returning (pfmt, data, old_data)
+
+        pfmt tells how b_convert turns the data into exported pixels; old_data
+        is None when the tile has none.
+        """
+        bdat = self.bdat
+        p = entry.offset+self.TILE_HEADER_SIZE[self.btype]
+        t_width, t_height, bl = entry.width, entry.height, entry.bl
+        o_bmp = None
+        
+        if self.btype == self.BIN_CONTAINER:
+            return 4, bdat[p:p+bl], o_bmp
+        elif entry.t_params & 0x08:  # Compression bit flag
+            t_bmp = self.b_uncompress(bdat[p:p+entry.t_len], bl//(64*64))
+            if len(t_bmp) > 0 and len(t_bmp) != t_width*t_height*bl//(64*64):
+                self.b_log(False, 3, f"Uncompressed tile data seems bogus (uncompressed {len(t_bmp)} bytes while expecting {t_width*t_height*bl//(64*64)}). Discarding tile.")
+                t_bmp = b""
+            return 2, t_bmp, o_bmp
+        cf = bl//(64*64)
+        t_end = p+cf*t_width*t_height
+        if cf == 1:
+            self.pal = True
+        if t_height != 64:
+            o_bmp = bdat[t_end:p+bl]
+        return cf, bdat[p:t_end], o_bmp
+
+    def b_convert(self, pfmt, data):
+        """Convert pixel data to its exported form: pfmt 1 = palette indexes, 2 = RGB565, 3/4 = RGB24/RGB32, 0 = as is"""
+        if pfmt == 4:
+            return self.b_parse_rgb32b(data)
+        elif pfmt == 3:
+            return self.b_parse_rgb24b(data)
+        elif pfmt == 2:
+            return self.b_parse_rgb565(data)
+        elif pfmt == 1:
+            return self.PALETTE+data
+        return data
+
+    def b_scan(self):
+        """Header-only pre-scan of the imported data into the tile index (self.tindex)"""
+        if len(self.bdat) == 0:
+            self.b_log(False, 3, "Nothing to scan.")
+            return False
+        self.b_ok = True
+        self.tindex = list(self.b_walk_headers(self.bstart))
+        self.b_log(True, 0, "%d tile headers indexed.", len(self.tindex))
+        return self.b_ok
+
+    def b_index(self):
+        """Fill the tile index from its sidecar if it is current, else by a header scan, saved with keep_index"""
+        if self.b_index_load():
+            return True
+        if not self.b_scan():
+            return False
+        if self.keep_index:
+            self.b_index_save()
+        return True
+
+    def b_index_save(self, iname=None):
+        """Write the tile index to a binary sidecar file (default: '<file>.idx')"""
+        if iname is None:
+            iname = self.fname+".idx"
+        st = os.stat(self.fname)
+        rec = Struct(self.INDEX_RECORD)
+        data = bytearray(self.INDEX_MAGIC+pack("<QQ4sL", st.st_size, st.st_mtime_ns, self.btype, len(self.tindex)))
+        for entry in self.tindex:
+            data += rec.pack(*entry)
+        try:
+            self.b_write(iname, data)
+        except Exception as e:
+            self.b_log(False, 3, f"Unable to write tile index '{iname}'. Error: {str(e)}")
+            return False
+        self.b_log(True, 0, "Tile index saved to '%s'.", iname)
+        return True
+
+    def b_index_load(self, iname=None):
+        """Load a sidecar tile index written by b_index_save, rejecting stale ones"""
+        if iname is None:
+            iname = self.fname+".idx"
+        try:
+            with open(iname, "rb") as f:
+                data = f.read()
+        except Exception as e:
+            self.b_log(True, 2, "Unable to read tile index '%s'. Error: %s", iname, e)
+            return False
+        hdr = len(self.INDEX_MAGIC)+24
+        st = os.stat(self.fname)
+        if len(data) < hdr or data[:len(self.INDEX_MAGIC)] != self.INDEX_MAGIC:
+            self.b_log(False, 3, f"'{iname}' is not a tile index.")
+            return False
+        size, mtime, btype, n = unpack_from("<QQ4sL", data, len(self.INDEX_MAGIC))
+        rec = Struct(self.INDEX_RECORD)
+        if (size, mtime, btype) != (st.st_size, st.st_mtime_ns, self.btype) or len(data) != hdr+n*rec.size:
+            self.b_log(False, 3, f"Tile index '{iname}' does not match '{self.fname}'; ignoring it.")
+            return False
+        self.tindex = [BMCEntry(*e) for e in rec.iter_unpack(data[hdr:])]
+        self.b_log(True, 0, "%d tile headers loaded from '%s'.", n, iname)
+        return True
+
+    def b_decode_tile(self, i):
+        """Random-access decode of the i-th indexed tile; returns a BMCTile or None"""
+        entry = self.tindex[i]
+        t_bmp, o_bmp = self.b_decode_entry(entry)
+        if len(t_bmp) == 0:
+            return None
+        return BMCTile(i, entry.key1, entry.key2, entry.width, entry.height, t_bmp, o_bmp)
+
+    def iter_range(self, start=0, stop=None):
+        """Decode indexed tiles start..stop-1; tiles are numbered by index position"""
+        for i in range(start, len(self.tindex) if stop is None else min(stop, len(self.tindex))):
+            tile = self.b_decode_tile(i)
+            if tile is not None:
+                yield tile
+
+    def iter_sample(self, budget=None, deadline=None):
+        """Triage: decode a sample of the tiles spread over the whole container within a time budget
+
+        Indexed tiles are visited coarse to fine (see b_sample_order), so the
+        tiles decoded when budget (seconds, default self.budget) or deadline
+        (a time.time() value, default self.deadline) runs out are spread over
+        the file. Tiles whose cache keys were already seen are skipped without
+        decoding. Tiles are numbered by index position, like iter_range and
+        the gallery; iter_tiles numbers them in extraction order instead,
+        which only differs after a discarded tile. self.coverage tells how
+        much of the file was covered.
+        """
+        budget = self.budget if budget is None else budget
+        deadline = self.deadline if deadline is None else deadline
+        t0 = time.time()
+        ends = [t for t in [t0+budget if budget else None, deadline] if t is not None]
+        end = min(ends) if ends else None
+        if len(self.tindex) == 0:
+            self.b_index()
+        keys = set()
+        n = self.ntiles = decoded = skipped = 0
+        for i in self.b_sample_order(len(self.tindex)):
+            if (end is not None and time.time() >= end) or (self.cnt != 0 and n == self.cnt):
+                break
+            entry = self.tindex[i]
+            key = (entry.key1, entry.key2)
+            if key != (0, 0):
+                if key in keys:
+                    skipped += 1
+                    continue
+                keys.add(key)
+            pfmt, t_bmp, o_bmp = self.b_decode_native(entry)
+            decoded += 1
+            # Same tests as iter_tiles, uniform tiles being told apart on their native pixels
+            if len(t_bmp) > 0 or pfmt == 1:
+                if not (self.skip_uniform and self.b_uniform_tile(pfmt, t_bmp, o_bmp)):
+                    o_bmp = self.b_convert(pfmt, o_bmp) if o_bmp is not None else b""
+                    yield BMCTile(i, entry.key1, entry.key2, entry.width, entry.height, self.b_convert(pfmt, t_bmp), o_bmp)
+                n = self.ntiles = n+1
+        
+        total = len(self.tindex)
+        self.coverage = {"tiles": total, "decoded": decoded, "skipped": skipped, "extracted": n, "seconds": time.time()-t0,
+                         "ratio": (decoded+skipped)/total if total else 1.0}
+        self.b_log(False, 0, f"Triage covered {decoded+skipped} of {total} tiles ({100*self.coverage['ratio']:.1f}%, {skipped} skipped as repeated keys) in {self.coverage['seconds']:.2f}s.")
+        self.b_log_uniform()
+
+    def b_sample_order(self, n):
+        """Positions 0..n-1 coarse to fine: every prefix of the order is spread over the whole range"""
+        seen = bytearray(n)
+        step = 1
+        while step < n:
+            step <<= 1
+        while step > 0:
+            for i in range(0, n, step):
+                if not seen[i]:
+                    seen[i] = 1
+                    yield i
+            step >>= 1
+
+    @classmethod
+    def b_rgb565_lut(cls):
+        """Build (once) the 65536-entry RGB565 lookup table"""
+        if cls.RGB565_LUT is None:
+            cls.RGB565_LUT = [bytes((((pxl<<3)&0xF8)|((pxl>>2)&0x07),
+                                     ((pxl>>3)&0xFC)|((pxl>>9)&0x03),
+                                     ((pxl>>8)&0xF8)|((pxl>>13)&0x07),
+                                     255)) for pxl in range(0x10000)]
+        return cls.RGB565_LUT
+
+    def b_parse_rgb565(self, data):
+        """Parse RGB565 data (a whole tile or a batch of tiles) in a single pass"""
+        pxls = array("H")
+        pxls.frombytes(data)
+        if sys.byteorder == "big":
+            pxls.byteswap()
+        return b"".join(map(self.b_rgb565_lut().__getitem__, pxls))
+
+    def b_parse_rgb32b(self, data):
+        """Parse RGB32 data into a preallocated buffer"""
+        return self.b_parse_rgbx(data, 4)
+
+    def b_parse_rgb24b(self, data):
+        """Parse RGB24 data into a preallocated buffer"""
+        return self.b_parse_rgbx(data, 3)
+
+    def b_parse_rgbx(self, data, cf):
+        """Expand cf-byte pixels to 4-byte pixels with an opaque alpha channel"""
+        n = len(data)//cf
+        d_out = bytearray(b"\xFF"*(4*n))
+        for i in range(3):
+            d_out[i::4] = data[i:cf*n:cf]
+        if len(data) > cf*n:
+            # Trailing partial pixel, kept as-is followed by the alpha byte
+            d_out += bytes(data[cf*n:][:3])+b"\xFF"
+        if self.btype == self.BIN_CONTAINER:
+            # BIN tiles are stored bottom-up: reverse the order of the complete
+            # 256-byte rows in one pass, dropping any incomplete last row
+            rows = len(d_out)//256
+            return b"".join([d_out[256*r:256*(r+1)] for r in range(rows-1, -1, -1)])
+        return bytes(d_out)
+
+    def b_unrle(self, data, p=0):
+        """RLE order header decoding through the 256-entry UNRLE_TABLE"""
+        if p >= len(data):
+            return (-1, 1, 0)
+        cmd, rl, sz, ext = self.UNRLE_TABLE[data[p]]
+        if ext == 0:
+            return (cmd, rl, sz)
+        if len(data)-p < sz:
+            return (-1, 1, 0)
+        if ext == 1:
+            return (cmd, data[p+1]+rl, sz)
+        return (cmd, data[p+1]|(data[p+2]<<8), sz)
+
+    def b_uncompress(self, data, bbp):
+        """Uncompress bitmap data into a preallocated tile buffer"""
+        row = 64*bbp
+        d_out = bytearray(64*row)
+        pos = 0
+        p = 0
+        bro = -1
+        fgc = self.COLOR_WHITE*bbp
+        handlers = self.rle_handlers
+        
+        while p < len(data):
+            cmd, rl, sz = self.b_unrle(data, p)
+            if cmd == -1:
+                if rl == 1:
+                    self.b_log(False, 3, "Unexpected end of compressed stream. Skipping tile.")
+                elif rl == 2:
+                    self.b_log(False, 3, f"Unexpected decompression command encountered (0x{sz:02X}). Skipping tile.")
+                else:
+                    self.b_log(False, 3, "Unhandled case in decompression routine. Skipping tile.")
+                return b""
+            
+            p += sz
+            
+            handler = handlers.get(cmd)
+            if handler is None:
+                self.b_log(False, 3, f"Unhandled decompression command (0x{cmd:02X}). Skipping tile.")
+                return b""
+            res = handler(data, p, d_out, pos, row, rl, fgc, bro)
+            if res is None:
+                self.b_log(False, 3, "Unexpected end of compressed stream. Skipping tile.")
+                return b""
+            p, pos, fgc, bro = res
+        return bytes(d_out[:pos])
+
+    def b_rle_bg_run(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Background run (0x00, 0xF0)"""
+        if pos < row:
+            if bro == 0:
+                pos = self.b_put(d_out, pos, fgc)
+                rl -= 1
+            pos = self.b_put(d_out, pos, (self.COLOR_BLACK*len(fgc))*rl)
+        else:
+            if bro > 0:
+                pos = self.b_xor_up(d_out, pos, row, fgc, 1)
+                rl -= 1
+            pos = self.b_copy_up(d_out, pos, row, rl*len(fgc))
+        return (p, pos, fgc, pos//row)
+
+    def b_rle_fg_run(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Foreground run (0x20, 0xF1)"""
+        if pos < row:
+            pos = self.b_put(d_out, pos, fgc*rl)
+        else:
+            pos = self.b_xor_up(d_out, pos, row, fgc, rl)
+        return (p, pos, fgc, -1)
+
+    def b_rle_set_fg_run(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Foreground run with a new foreground colour (0xC0, 0xF6)"""
+        bbp = len(fgc)
+        if len(data)-p < bbp:
+            return None
+        return self.b_rle_fg_run(data, p+bbp, d_out, pos, row, rl, bytes(data[p:p+bbp]), bro)
+
+    def b_rle_dither_run(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Dithered run of two colours (0xE0, 0xF8)"""
+        n = 2*len(fgc)
+        if len(data)-p < n:
+            return None
+        return (p+n, self.b_put(d_out, pos, bytes(data[p:p+n])*rl), fgc, -1)
+
+    def b_rle_color_run(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Colour run (0x60, 0xF3)"""
+        n = len(fgc)
+        if len(data)-p < n:
+            return None
+        return (p+n, self.b_put(d_out, pos, bytes(data[p:p+n])*rl), fgc, -1)
+
+    def b_rle_mix_run(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Foreground/background image with an explicit bitmask (0x40, 0xF2)"""
+        ml = (rl+7)//8
+        if len(data)-p < ml:
+            return None
+        return (p+ml, self.b_mix_run(d_out, pos, row, fgc, data[p:p+ml], rl), fgc, -1)
+
+    def b_rle_set_mix_run(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Foreground/background image with a new foreground colour (0xD0, 0xF7)"""
+        bbp = len(fgc)
+        if len(data)-p < bbp:
+            return None
+        return self.b_rle_mix_run(data, p+bbp, d_out, pos, row, rl, bytes(data[p:p+bbp]), bro)
+
+    def b_rle_mix_3(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Special foreground/background image with mask 0x03 (0xF9)"""
+        return (p, self.b_mix_run(d_out, pos, row, fgc, b"\x03", rl), fgc, -1)
+
+    def b_rle_mix_5(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Special foreground/background image with mask 0x05 (0xFA)"""
+        return (p, self.b_mix_run(d_out, pos, row, fgc, b"\x05", rl), fgc, -1)
+
+    def b_rle_copy(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Raw pixel copy (0x80, 0xF4)"""
+        n = rl*len(fgc)
+        if len(data)-p < n:
+            return None
+        return (p+n, self.b_put(d_out, pos, data[p:p+n]), fgc, -1)
+
+    def b_rle_white(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Single white pixel (0xFD)"""
+        return (p, self.b_put(d_out, pos, self.COLOR_WHITE*len(fgc)), fgc, -1)
+
+    def b_rle_black(self, data, p, d_out, pos, row, rl, fgc, bro):
+        """Single black pixel (0xFE)"""
+        return (p, self.b_put(d_out, pos, self.COLOR_BLACK*len(fgc)), fgc, -1)
+
+    @staticmethod
+    def b_put(d_out, pos, chunk):
+        """Write chunk at the cursor, growing the buffer only for oversized tiles"""
+        end = pos+len(chunk)
+        d_out[pos:end] = chunk
+        return end
+
+    @staticmethod
+    def b_copy_up(d_out, pos, row, n):
+        """Copy n bytes from the previous scanline to the cursor"""
+        while n > 0:
+            c = min(n, row)
+            d_out[pos:pos+c] = d_out[pos-row:pos-row+c]
+            pos += c
+            n -= c
+        return pos
+
+    @staticmethod
+    def b_xor_up(d_out, pos, row, fgc, rl):
+        """Write rl pixels of the previous scanline XORed with the foreground colour"""
+        n = rl*len(fgc)
+        while n > 0:
+            c = min(n, row)
+            x = int.from_bytes(d_out[pos-row:pos-row+c], "little")^int.from_bytes(fgc*(c//len(fgc)), "little")
+            d_out[pos:pos+c] = x.to_bytes(c, "little")
+            pos += c
+            n -= c
+        return pos
+
+    def b_mix_run(self, d_out, pos, row, fgc, msk, rl):
+        """Write rl pixels selected by a bitmask: foreground where set, background elsewhere"""
+        bbp = len(fgc)
+        k = 0
+        while k < rl:
+            # Group consecutive pixels sharing the same mask bit
+            b = (msk[k>>3]>>(k&7))&1
+            j = k+1
+            while j < rl and ((msk[j>>3]>>(j&7))&1) == b:
+                j += 1
+            n = j-k
+            if pos < row:
+                m = min(n, (row-pos)//bbp)
+                pos = self.b_put(d_out, pos, (fgc if b else self.COLOR_BLACK*bbp)*m)
+                n -= m
+            if n > 0:
+                if b:
+                    pos = self.b_xor_up(d_out, pos, row, fgc, n)
+                else:
+                    pos = self.b_copy_up(d_out, pos, row, n*bbp)
+            k = j
+        return pos
+
+    def b_export(self, dname, tiles=None):
+        """Export bitmaps, either those kept by b_process or any stream of tiles (e.g. iter_tiles())"""
+        if not os.path.isdir(dname):
+            self.b_log(False, 3, "Destination must be an already existing folder.")
+            return False
+        
+        stored = tiles is None
+        if stored:
+            tiles = self.b_stored_tiles()
+        sink = self.SINKS[self.fmt](dname, os.path.basename(self.fname))
+        if self.stats:
+            sink.b_write = self.stats.b_timed("write", sink.b_write, lambda args, res: len(args[1]))
+            sink.b_write_chunks = self.stats.b_timed("write", sink.b_write_chunks, lambda args, res: args[1])
+        # Pipelined mode: tiles are encoded and written by writer threads while decoding goes on
+        writer = BMCWriter(self.b_write_tile, self.writers) if self.writers > 0 else None
+        stitcher = None
+        try:
+            tiles = self.b_export_tiles(sink, tiles, writer)
+            if self.stitch:
+                from bitmap_cache_stitcher import BMCStitcher
+                stitcher = BMCStitcher()
+                tiles = stitcher.b_collect(tiles)
+            if self.phashes is not None:
+                from bitmap_cache_phash import b_collect_phashes
+                tiles = b_collect_phashes(tiles, self.phashes)
+            if self.big:
+                self.b_export_collage(sink, tiles, stored)
+            else:
+                for _ in tiles:
+                    pass
+            if stitcher:
+                self.b_export_mosaics(sink, stitcher)
+        finally:
+            try:
+                if writer:
+                    writer.b_close()
+            finally:
+                if stitcher:
+                    stitcher.b_close()
+                sink.b_close()
+        if sink.EXT:
+            self.b_log(True, 0, "Bitmaps stored in '%s'.", sink.path)
+        
+        return True
+
+    def b_stored_tiles(self):
+        """Yield the tiles kept by b_process as BMCTile records"""
+        for i in range(len(self.store)):
+            yield self.b_stored_tile(i)
+
+    def b_stored_tile(self, i):
+        """Tile i of the store, converted to exported pixels"""
+        tile = self.store.b_get(i)
+        t_bmp = self.b_convert(tile.pfmt, tile.data)
+        o_bmp = self.b_convert(tile.pfmt, tile.old_data) if tile.old_data is not None else b""
+        return BMCTile(tile.index, tile.key1, tile.key2, 64, len(t_bmp)//256, t_bmp, o_bmp)
+
+    def b_export_tiles(self, sink, tiles, writer=None):
+        """Streaming stage writing one BMP per tile to the output sink (or through writer), passing the tiles on"""
+        fname_base = os.path.basename(self.fname)
+        put = writer.b_put if writer else self.b_write_tile
+        n = 0
+        dups = len(self.dedup.dups) if self.dedup else 0
+        for tile in tiles:
+            put(sink, f"{fname_base}_{tile.index:04d}.bmp", tile.data, (tile.key1, tile.key2))
+            if self.oldsave and len(tile.old_data) > 0:
+                put(sink, f"{fname_base}_old_{tile.index:04d}.bmp", tile.old_data)
+            n += 1
+            yield tile
+        if writer:
+            writer.b_close()
+        
+        self.b_log(False, 0, f"Successfully exported {n} files.")
+        if self.dedup:
+            self.b_log(False, 0, f"{len(self.dedup.dups)-dups} duplicate bitmaps recorded in the dedup manifest instead of being written.")
+
+    def b_write_tile(self, sink, name, data, key=None):
+        """Write one tile bitmap, unless the dedup layer already has a copy of it"""
+        if self.dedup and self.dedup.b_lookup(os.path.join(sink.path, name), data, key) is not None:
+            return False
+        return sink.b_write(name, self.b_export_bmp(64, len(data)//256, data))
+
+    def b_export_collage(self, sink, tiles, stored=False):
+        """Streaming stage consuming the tiles to write the collage bitmap to the output sink
+
+        The collage is written one band of STRIPE_WIDTH tiles at a time and the
+        tiles themselves are left untouched. Stored tiles are converted again
+        from self.store band by band; other tiles are spooled to a temporary
+        file until the collage size, and so its header, is known.
+        """
+        fname_base = os.path.basename(self.fname)
+        spool = None
+        if stored:
+            n = sum(1 for _ in tiles)
+            tile_data = lambda i: self.b_convert(self.store.pfmts[i], self.store.b_get(i).data)
+        else:
+            spool = tempfile.TemporaryFile()
+            recs = []
+            for tile in tiles:
+                recs.append((spool.tell(), len(tile.data)))
+                spool.write(tile.data)
+            n = len(recs)
+            
+            def tile_data(i):
+                spool.seek(recs[i][0])
+                return spool.read(recs[i][1])
+        try:
+            pad = b"\xFF"
+            if not self.pal:
+                pad *= 4
+            cols = n
+            rows = 1
+            if n//self.STRIPE_WIDTH > 0:
+                cols = self.STRIPE_WIDTH
+                rows = (n+cols-1)//cols
+            size = 64*cols*64*rows*len(pad)
+            if self.pal:
+                size += len(self.PALETTE)
+            header = self.b_bmp_header(64*cols, 64*rows, size)
+            sink.b_write_chunks(f"{fname_base}_collage.bmp", len(header)+size,
+                                chain([header], self.b_collage_bands(n, tile_data, cols, rows, pad)))
+        finally:
+            if spool:
+                spool.close()
+        self.b_log(False, 0, "Successfully exported collage file.")
+        return True
+
+    def b_collage_bands(self, n, tile_data, cols, rows, pad):
+        """Yield the pixel data of the collage (palette first), one band of tiles at a time
+
+        tile_data(i) returns the data of tile i of n. Missing tiles of the last
+        band and short tiles are filled with pad.
+        """
+        if self.pal:
+            yield self.PALETTE
+        row = 64*len(pad)
+        tile_size = 64*row
+        for x in range(rows):
+            band = []
+            for k in range(cols):
+                i = cols*x+k
+                if self.btype == self.BIN_CONTAINER:
+                    # BIN tiles are laid out right to left within a band
+                    i = cols*(x+1)-1-k
+                if i >= n:
+                    band.append(pad*(tile_size//len(pad)))
+                    continue
+                data = tile_data(i)
+                if self.pal:
+                    data = data[len(self.PALETTE):]
+                if len(data) < tile_size:
+                    data += pad*64*((tile_size-len(data)+row-1)//row)
+                band.append(data)
+            yield b"".join([data[row*j:row*(j+1)] for j in range(64) for data in band])
+
+    def b_export_mosaics(self, sink, stitcher):
+        """Write the screen mosaics reassembled by a BMCStitcher to the output sink"""
+        fname_base = os.path.basename(self.fname)
+        n = 0
+        for width, height, chunks in stitcher.b_mosaics():
+            n += 1
+            size = 4*width*height
+            header = self.b_bmp_header(width, height, size, False)
+            sink.b_write_chunks(f"{fname_base}_mosaic_{n:03d}.bmp", len(header)+size, chain([header], chunks))
+        self.b_log(False, 0, f"{n} stitched mosaics exported ({stitcher.placed} of {len(stitcher)} tiles placed).")
+        return True
+
+    def b_export_bmp(self, width, height, data):
+        """Export BMP format - exact copy from original"""
+        return self.b_bmp_header(width, height, len(data))+data
+
+    def b_bmp_header(self, width, height, size, pal=None):
+        """BMP headers for size bytes of pixel data (palette included in 8-bit mode, by default self.pal)"""
+        if not (self.pal if pal is None else pal):
+            return b"BM"+pack("<L", size+122)+b"\x00\x00\x00\x00\x7A\x00\x00\x00\x6C\x00\x00\x00"+pack("<L", width)+pack("<L", height)+b"\x01\x00\x20\x00\x03\x00\x00\x00"+pack("<L", size)+b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xFF\x00\x00\xFF\x00\x00\xFF\x00\x00\x00\x00\x00\x00\xFF niW"+(b"\x00"*36)+b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+        else:
+            return b"BM"+pack("<L", size+0x36)+b"\x00\x00\x00\x00\x36\x04\x00\x00\x28\x00\x00\x00"+pack("<L", width)+pack("<L", height)+b"\x01\x00\x08\x00\x00\x00\x00\x00"+pack("<L", size-0x400)+b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+    def b_write(self, fname, data):
+        """Write file - exact copy from original"""
+        with open(fname, "wb") as f:
+            f.write(data)
+        return True
+
+    def b_flush(self):
+        """Clear processed data and release the imported file"""
+        self.b_release()
+        self.store = BMCTileStore()
+        return True
+
+    def b_release(self):
+        """Drop the imported data, unmapping the file when it was memory-mapped"""
+        if isinstance(self.bdat, memoryview):
+            self.bdat.release()
+        if self.bmap is not None:
+            try:
+                self.bmap.close()
+            except BufferError:
+                # Some payload view is still alive; the map is closed once it is collected
+                pass
+            self.bmap = None
+        self.bdat = b""
+        self.boff = self.bstart = 0
+        self.tindex = []
+        return True
+
+class BMCDedup():
+    """Content-addressed record of the tiles written under a destination folder
+
+    Each exported bitmap is identified by a digest of its decoded data; a
+    tile whose digest was already written is only recorded as a reference to
+    the first copy. In "keys" mode the cache keys (key1, key2) of a tile are
+    trusted as a first-level identity, so repeated keys are not even hashed.
+    The state is kept in MANIFEST so later runs deduplicate against it too.
+    """
+    MANIFEST = "dedup_manifest.json"
+    MODES = ["hash", "keys"]
+
+    def __init__(self, dname, mode="hash", tiles=None, keys=None):
+        self.dname = dname
+        self.mode = mode
+        # digest -> name of the first copy, (key1, key2) -> digest; these may be
+        # multiprocessing manager dicts shared by several worker processes
+        self.tiles = {} if tiles is None else tiles
+        self.keys = {} if keys is None else keys
+        # (duplicate name, name of the first copy) pairs found by this instance
+        self.dups = []
+
+    def b_load(self):
+        """Merge the manifest left in the destination folder by a previous run; a corrupt one is ignored"""
+        try:
+            with open(os.path.join(self.dname, self.MANIFEST), "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        self.tiles.update(manifest.get("tiles", {}))
+        self.keys.update({tuple(int(k) for k in key.split(":")): digest for key, digest in manifest.get("keys", {}).items()})
+        self.dups.extend(manifest.get("duplicates", {}).items())
+        return True
+
+    def b_save(self):
+        """Atomically rewrite the manifest: unique tiles, known cache keys and duplicate references"""
+        manifest = {
+            "mode": self.mode,
+            "tiles": dict(self.tiles),
+            "keys": {f"{k1}:{k2}": digest for (k1, k2), digest in dict(self.keys).items()},
+            "duplicates": dict(self.dups),
+        }
+        mname = os.path.join(self.dname, self.MANIFEST)
+        with open(mname+".tmp", "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(mname+".tmp", mname)
+        return True
+
+    def b_lookup(self, fname, data, key=None):
+        """Register the bitmap about to be written as fname
+
+        Returns None when it must be written, or the name of the already
+        written copy, in which case the reference is recorded.
+        """
+        name = os.path.relpath(fname, self.dname)
+        digest = None
+        if self.mode == "keys" and key is not None and key != (0, 0):
+            digest = self.keys.get(key)
+        if digest is None:
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            if self.mode == "keys" and key is not None and key != (0, 0):
+                self.keys.setdefault(key, digest)
+        first = self.tiles.setdefault(digest, name)
+        if first == name:
+            return None
+        self.dups.append((name, first))
+        return first
+
+class BMCRunManifest():
+    """Record of the source files already processed into a destination folder
+
+    Each successfully processed file is stored with its size, mtime, SHA-256
+    and the export settings used, so that a re-run can skip the files which
+    did not change since and were exported with the same settings.
+    """
+    MANIFEST = "processed_manifest.json"
+
+    def __init__(self, dname):
+        self.dname = dname
+        self.files = {}
+
+    def b_load(self):
+        try:
+            with open(os.path.join(self.dname, self.MANIFEST), "r") as f:
+                self.files = json.load(f).get("files", {})
+        except (FileNotFoundError, ValueError):
+            # A corrupt manifest only means the files are processed again
+            return False
+        return True
+
+    def b_save(self):
+        """Atomically rewrite the manifest, so an interrupted run keeps what it has done"""
+        mname = os.path.join(self.dname, self.MANIFEST)
+        with open(mname+".tmp", "w") as f:
+            json.dump({"files": self.files}, f, indent=1)
+        os.replace(mname+".tmp", mname)
+        return True
+
+    def b_unchanged(self, fname, settings):
+        """Tell whether fname was already processed, unchanged, with the same settings"""
+        entry = self.files.get(os.path.abspath(fname))
+        if entry is None or entry["settings"] != settings:
+            return False
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return False
+        if st.st_size != entry["size"]:
+            return False
+        if st.st_mtime_ns != entry["mtime"]:
+            # Touched but maybe not modified: only the content hash can tell
+            if b_file_sha256(fname) != entry["sha256"]:
+                return False
+            entry["mtime"] = st.st_mtime_ns
+        return True
+
+    def b_record(self, res, settings):
+        """Remember a successfully processed file (a b_process_file result)"""
+        self.files[os.path.abspath(res["file"])] = {"size": res["size"], "mtime": res["mtime"], "sha256": res["sha256"], "settings": settings}
+        return True
+
+def b_decode_chunk(fname, verbose, entries):
+    """Process-pool worker decoding a run of tile entries of fname
+
+    The decoded tiles are packed into one shared memory block whose name is
+    returned with the per-tile (data, old_data) lengths, the log lines of
+    each tile and whether palette tiles were seen. Outside POSIX systems the
+    packed bytes are returned instead of the block name.
+    """
+    from multiprocessing import resource_tracker, shared_memory
+    logs = []
+    bmcc = BMCContainer(verbose=verbose, log_callback=logs.append, use_mmap=True)
+    if not bmcc.b_import(fname):
+        raise IOError(f"Unable to map '{fname}' in decoding worker.")
+    tiles = []
+    t_logs = []
+    for entry in entries:
+        del logs[:]
+        tiles.append(bmcc.b_decode_entry(entry))
+        t_logs.append(list(logs))
+    bmcc.b_flush()
+    
+    layout = [(len(t_bmp), len(o_bmp)) for t_bmp, o_bmp in tiles]
+    if os.name != "posix":
+        # A Windows named mapping dies with its last handle, before the parent
+        # could attach to it: send the data back through the pickled result
+        return b"".join(chain.from_iterable(tiles)), layout, t_logs, bmcc.pal
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(a+b for a, b in layout)))
+    # The parent process attaches to and unlinks the block; do not let this
+    # worker's resource tracker reclaim it when the worker exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        pos = 0
+        for t_bmp, o_bmp in tiles:
+            for data in (t_bmp, o_bmp):
+                shm.buf[pos:pos+len(data)] = data
+                pos += len(data)
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    name = shm.name
+    shm.close()
+    return name, layout, t_logs, bmcc.pal
+
+def b_collect_chunk(result):
+    """Copy a chunk decoded by b_decode_chunk out of shared memory (or its returned bytes) and free it"""
+    block, layout, t_logs, pal = result
+    if isinstance(block, bytes):
+        return b_split_chunk(block, layout), t_logs, pal
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=block)
+    try:
+        tiles = b_split_chunk(shm.buf, layout)
+    finally:
+        shm.close()
+        shm.unlink()
+    return tiles, t_logs, pal
+
+def b_split_chunk(buf, layout):
+    """(data, old_data) byte strings of the tiles packed in buf, as laid out by b_decode_chunk"""
+    tiles = []
+    pos = 0
+    for t_len, o_len in layout:
+        tiles.append((bytes(buf[pos:pos+t_len]), bytes(buf[pos+t_len:pos+t_len+o_len])))
+        pos += t_len+o_len
+    return tiles
+
+def b_find_files(source):
+    """List the .bmc/.bin cache files under source (or source itself if it is a file)"""
+    if not os.path.isdir(source):
+        return [source]
+    src_files = []
+    for root, dirs, files in os.walk(source):
+        for f in files:
+            if f.rsplit(".", 1)[-1].upper() in ["BIN", "BMC"]:
+                src_files.append(os.path.join(root, f))
+    return src_files
+
+def b_kape_destination(src, dname):
+    """Per-file output folder used in KAPE mode, created if needed"""
+    destination = src.replace("\\", "_").replace("//", "_").replace(":", "_")
+    destination = destination.replace("_AppData_Local_Microsoft_Terminal Server Client_Cache", "")
+    # A POSIX source path is still absolute or relative here: keep it under dname
+    parts = [p for p in os.path.splitdrive(destination)[1].replace(os.sep, "/").split("/") if p not in ["", ".", ".."]]
+    destination = os.path.join(dname, *parts)
+    os.makedirs(destination, exist_ok=True)
+    return destination
+
+def b_process_file(src, dname, kape=False, options=None, log_callback=None, stats=False):
+    """Import, decode and export one cache file with its own BMCContainer
+
+    options are BMCContainer keyword arguments. Without log_callback the log
+    lines are collected in the result, so this can run in a worker process.
+    Returns a result dict: file, ok, tiles, seconds, error, logs, the
+    duplicate references recorded by the dedup layer, if any, the size and
+    mtime of the file (and its SHA-256 once fully processed), with stats
+    its BMCStats report and, in triage mode (a budget or deadline option),
+    its coverage, and the count per colour of the uniform tiles skipped.
+    """
+    res = {"file": src, "ok": False, "tiles": 0, "seconds": 0.0, "error": None, "logs": [], "duplicates": [],
+           "size": 0, "mtime": 0, "sha256": None, "stats": None, "coverage": None, "uniform": {}, "phashes": None}
+    t0 = time.time()
+    bstats = BMCStats() if stats else None
+    bmcc = BMCContainer(log_callback=log_callback or res["logs"].append, stats=bstats, **(options or {}))
+    dups = len(bmcc.dedup.dups) if bmcc.dedup else 0
+    try:
+        if not bmcc.b_import(src):
+            res["error"] = "import failed"
+        else:
+            st = os.stat(src)
+            res["size"], res["mtime"] = st.st_size, st.st_mtime_ns
+            destination = b_kape_destination(src, dname) if kape else dname
+            # Triage mode when a time budget is set
+            tiles = bmcc.iter_sample() if bmcc.budget or bmcc.deadline else bmcc.iter_tiles()
+            res["ok"] = bmcc.b_export(destination, tiles) and bmcc.b_ok
+            res["tiles"] = bmcc.ntiles
+            res["coverage"] = bmcc.coverage
+            res["uniform"] = bmcc.uniform
+            res["phashes"] = bmcc.phashes
+            # The content hash is only needed to record a fully covered file as processed
+            if res["ok"] and (bmcc.coverage is None or bmcc.coverage["ratio"] >= 1.0):
+                res["sha256"] = hashlib.sha256(bmcc.bdat).hexdigest()
+            if not res["ok"]:
+                res["error"] = "processing failed"
+    except Exception as e:
+        res["ok"] = False
+        res["error"] = str(e)
+    finally:
+        bmcc.b_flush()
+    if bmcc.dedup:
+        res["duplicates"] = bmcc.dedup.dups[dups:]
+    res["seconds"] = time.time()-t0
+    if bstats:
+        res["stats"] = bstats.b_report(src, res["tiles"], res["size"])
+    return res
+
+def b_peak_memory():
+    """Peak resident memory of this process in KiB, where the platform tells it"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak//1024 if sys.platform == "darwin" else peak
+
+def b_run_report(results, wall, rname):
+    """Write the BMCStats reports of a batch with their run-wide totals to rname as JSON"""
+    files = [res["stats"] for res in results if res.get("stats")]
+    stages = {}
+    for report in files:
+        for stage, st in report["stages"].items():
+            total = stages.setdefault(stage, {"calls": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0})
+            for k in total:
+                total[k] += st[k]
+    tiles = sum(report["tiles"] for report in files)
+    nbytes = sum(report["bytes"] for report in files)
+    peaks = [p for p in [b_peak_memory()]+[report["peak_memory_kb"] for report in files] if p is not None]
+    run = {
+        "files": len(results),
+        "failed": sum(1 for res in results if not res["ok"]),
+        "tiles": tiles,
+        "bytes": nbytes,
+        "wall": wall,
+        "tiles_per_sec": tiles/wall if wall > 0 else 0.0,
+        "bytes_per_sec": nbytes/wall if wall > 0 else 0.0,
+        "peak_memory_kb": max(peaks) if peaks else None,
+        "stages": stages,
+    }
+    with open(rname, "w") as f:
+        json.dump({"run": run, "files": files}, f, indent=1)
+    return run
+
+def b_file_size(fname):
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return 0
+
+def b_file_sha256(fname):
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1<<20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def b_batch(files, dname, kape=False, options=None, workers=1, log_callback=None, progress=None, stop=None, dedup=None, force=False, report=None, budget=None, phash=None):
+    """Process many cache files, largest first, on up to workers processes
+
+    Each file gets its own container state (see b_process_file). progress is
+    called as progress(done, total, result) after each file and stop() is
+    polled between files. dedup selects a BMCDedup mode shared by all files
+    and previous runs into dname. Files recorded in dname's BMCRunManifest
+    as unchanged and exported with the same settings are skipped, unless
+    force is set; the manifests are saved every MANIFEST_SAVE_INTERVAL
+    seconds and at the end. With report, per-stage statistics are gathered for each
+    file (see BMCStats) and written with run totals to that JSON file.
+    budget is a time budget in seconds for the whole run: the files are
+    then triaged (see BMCContainer.iter_sample), each with a fair share of
+    the time left, and files only partly covered are not recorded as
+    processed. Triaged files are never taken as processed by a full run
+    (nor the other way round). With phash, the perceptual hashes of the exported tiles are
+    added to that BMCPhashIndex file. Returns the per-file results in
+    completion order.
+    """
+    emit = log_callback or print
+    results = []
+    t0 = time.perf_counter()
+    deadline = time.time()+budget if budget else None
+    
+    index = None
+    if phash:
+        from bitmap_cache_phash import BMCPhashIndex
+        index = BMCPhashIndex(phash)
+        index.b_load()
+        options = dict(options or {}, phash=True)
+    
+    # Only the options that change the exported files matter for re-runs
+    settings = {k: v for k, v in (options or {}).items() if k in ["count", "old", "big", "width", "fmt", "skip_uniform", "stitch"]}
+    settings.update(kape=kape, dedup=dedup)
+    if budget or (options or {}).get("budget"):
+        # Triage skips repeated keys without exporting them: a triaged file never stands for a full run
+        settings["triage"] = True
+    processed = BMCRunManifest(dname)
+    processed.b_load()
+    if not force:
+        # Indexing does not change the exported files, but files missing from the index still have to be hashed
+        todo = [src for src in files if not processed.b_unchanged(src, settings)
+                or (index is not None and os.path.abspath(src) not in index.source_ids)]
+        if len(todo) < len(files):
+            emit(f"[---] {len(files)-len(todo)} unchanged file(s) skipped (force to reprocess them).")
+        files = todo
+    files = sorted(files, key=b_file_size, reverse=True)
+    manager = None
+    if dedup:
+        if workers > 1:
+            from multiprocessing import Manager
+            manager = Manager()
+            deduper = BMCDedup(dname, dedup, manager.dict(), manager.dict())
+            deduper.b_load()
+            # Workers share the digest and key maps; their references come back with the results
+            options = dict(options or {}, dedup=BMCDedup(dname, dedup, deduper.tiles, deduper.keys))
+        else:
+            deduper = BMCDedup(dname, dedup)
+            deduper.b_load()
+            options = dict(options or {}, dedup=deduper)
+    
+    def b_share(left):
+        """Options for the next file with its share of the time left before the deadline"""
+        if deadline is None:
+            return options
+        share = max(0.0, deadline-time.time())*min(workers, left)/left
+        file_budget = (options or {}).get("budget")
+        return dict(options or {}, budget=min(file_budget, share) if file_budget else share, deadline=deadline)
+    
+    # Files done since the manifests were last saved: a file is only recorded
+    # as processed once its dedup references and index entries are on disk,
+    # so an interrupted run loses neither
+    unsaved = []
+    last_save = [time.perf_counter()]
+    
+    def b_save_manifests(final=False):
+        if dedup:
+            deduper.b_save()
+        if index is not None:
+            index.b_save(tables=final)
+        for res in unsaved:
+            processed.b_record(res, settings)
+        del unsaved[:]
+        processed.b_save()
+        last_save[0] = time.perf_counter()
+    
+    def b_done(res):
+        results.append(res)
+        if res["ok"]:
+            emit(f"[===] '{res['file']}': {res['tiles']} tiles in {res['seconds']:.2f}s.")
+            if index is not None and res.get("phashes") is not None:
+                index.b_add(os.path.abspath(res["file"]), res["phashes"])
+            # A triaged file only partly covered still has to be processed in full later
+            if res["coverage"] is None or res["coverage"]["ratio"] >= 1.0:
+                unsaved.append(res)
+            # Rewriting the manifests after every file would be quadratic in the run size
+            if time.perf_counter()-last_save[0] >= MANIFEST_SAVE_INTERVAL:
+                b_save_manifests()
+        else:
+            emit(f"[!!!] '{res['file']}' failed: {res['error']}")
+        if progress:
+            progress(len(results), len(files), res)
+    
+    try:
+        if workers <= 1:
+            for i, src in enumerate(files):
+                if stop and stop():
+                    break
+                emit(f"[+++] Processing file: '{src}'")
+                b_done(b_process_file(src, dname, kape, b_share(len(files)-i), emit, bool(report)))
+        else:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            # Files are already spread over the workers; keep each file's decoding serial
+            options = dict(options or {}, workers=1)
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                futs = {ex.submit(b_process_file, src, dname, kape, b_share(len(files)), None, bool(report)): src for src in files}
+                for fut in as_completed(futs):
+                    if stop and stop():
+                        for f in futs:
+                            f.cancel()
+                        break
+                    try:
+                        res = fut.result()
+                    except Exception as e:
+                        res = {"file": futs[fut], "ok": False, "tiles": 0, "seconds": 0.0, "error": str(e), "logs": [], "duplicates": [],
+                               "size": 0, "mtime": 0, "sha256": None, "stats": None, "coverage": None, "uniform": {}, "phashes": None}
+                    for log_message in res["logs"]:
+                        emit(log_message)
+                    if dedup:
+                        deduper.dups.extend(res["duplicates"])
+                    b_done(res)
+    finally:
+        try:
+            b_save_manifests(final=True)
+            if dedup:
+                emit(f"[===] Dedup manifest updated: {len(deduper.tiles)} unique bitmaps, {len(deduper.dups)} duplicate references.")
+        finally:
+            if manager:
+                manager.shutdown()
+        if index is not None:
+            emit(f"[===] Perceptual-hash index '{phash}' updated: {len(index)} tiles from {len(index.sources)} files.")
+    failed = sum(1 for res in results if not res["ok"])
+    emit(f"[===] {len(results)} file(s) processed, {failed} failed.")
+    if report:
+        run = b_run_report(results, time.perf_counter()-t0, report)
+        emit(f"[===] Run report written to '{report}': {run['tiles_per_sec']:.1f} tiles/s, {run['bytes_per_sec']/(1<<20):.2f} MiB/s.")
+    return results
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="RDP Bitmap Cache parser (command-line front end).")
+    parser.add_argument("-s", "--src", help="Specify the BMCache file or directory to process.")
+    parser.add_argument("-d", "--dest", help="Specify the directory where to store the extracted bitmaps.")
+    parser.add_argument("-c", "--count", type=int, default=0, help="Only extract the given number of bitmaps (0 = all).")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Determine the amount of information displayed.")
+    parser.add_argument("-o", "--old", action="store_true", help="Extract the old bitmap data found in the BMCache file.")
+    parser.add_argument("-b", "--bitmap", action="store_true", help="Provide a big bitmap aggregating all the tiles.")
+    parser.add_argument("-w", "--width", type=int, default=64, help="Specify the number of tiles per line of the aggregated bitmap (default=64).")
+    parser.add_argument("-k", "--kape", action="store_true", help="Store the bitmaps of each file in a separate folder named after its path.")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="Number of files processed in parallel (default=1).")
+    parser.add_argument("--decode-workers", type=int, default=1, help="Number of processes decoding the tiles of a single file (default=1).")
+    parser.add_argument("--dedup", choices=BMCDedup.MODES, help="Write identical bitmaps only once, recording duplicates in a manifest (keys = trust the cache keys).")
+    parser.add_argument("--force", action="store_true", help="Reprocess files already recorded as processed in the destination.")
+    parser.add_argument("--writers", type=int, default=0, help="Number of threads writing the bitmaps while decoding goes on (default=0, write inline).")
+    parser.add_argument("--mmap", action="store_true", help="Memory-map the cache files instead of reading them in full.")
+    parser.add_argument("-f", "--format", choices=list(BMCContainer.SINKS), default="bmp", help="Store the bitmaps as separate files (bmp) or in one archive per cache file (zip, tar; default=bmp).")
+    parser.add_argument("--skip-uniform", action="store_true", help="Do not export blank and solid-colour tiles, only count them per colour.")
+    parser.add_argument("--stitch", action="store_true", help="Reassemble neighbouring tiles into screen mosaics by matching their borders.")
+    parser.add_argument("--phash", help="Add the perceptual hashes of the exported tiles to this index file (see bitmap_cache_phash.py).")
+    parser.add_argument("--triage", type=float, help="Triage mode: sample the tiles of each file spread over the file for at most this many seconds.")
+    parser.add_argument("--triage-run", type=float, help="Triage mode with a time budget in seconds for the whole run, shared between the files.")
+    parser.add_argument("--keep-index", action="store_true", help="Save the tile index of each file scanned in triage mode next to it ('<file>.idx'), so later runs skip the header scan.")
+    parser.add_argument("--carve", action="store_true", help="Treat the source as a raw disk image or memory dump and carve the cache containers out of it.")
+    parser.add_argument("--report", help="Write per-stage timings, throughput and peak memory of each file and of the run to this JSON file.")
+    parser.add_argument("--gui", action="store_true", help="Launch the graphical interface instead.")
+    args = parser.parse_args(argv)
+    
+    if args.gui:
+        # Tk is only loaded when the GUI is actually requested
+        from bitmap_cache_parser_gui import main as gui_main
+        gui_main()
+        return 0
+    if args.src is None or args.dest is None:
+        parser.error("the following arguments are required: -s/--src, -d/--dest")
+    if not os.path.exists(args.src):
+        print(f"{BMCContainer.LOG_TYPES[3]} Source path '{args.src}' does not exist.")
+        return 1
+    if not os.path.isdir(args.dest):
+        print(f"{BMCContainer.LOG_TYPES[3]} Destination must be an already existing folder.")
+        return 1
+    
+    options = dict(verbose=args.verbose, count=max(0, args.count), old=args.old, big=args.bitmap,
+                   width=args.width, use_mmap=args.mmap, workers=max(1, args.decode_workers), fmt=args.format, writers=max(0, args.writers), budget=args.triage, skip_uniform=args.skip_uniform, stitch=args.stitch, keep_index=args.keep_index)
+    if args.carve:
+        # Carved containers are exported straight from the image, without the per-file batch layers
+        unsupported = [flag for flag, value in (("--triage", args.triage), ("--triage-run", args.triage_run), ("--dedup", args.dedup),
+                                                ("--phash", args.phash), ("--report", args.report), ("--kape", args.kape), ("--force", args.force)) if value]
+        if unsupported:
+            parser.error(f"--carve cannot be combined with {', '.join(unsupported)}")
+        if not os.path.isfile(args.src):
+            print(f"{BMCContainer.LOG_TYPES[3]} Carving needs a single image file as source.")
+            return 1
+        from bitmap_cache_carver import b_carve
+        records = b_carve(args.src, args.dest, options, workers=max(1, args.workers))
+        return 0 if all(r["ok"] for r in records) else 1
+    
+    src_files = b_find_files(args.src)
+    if len(src_files) == 0:
+        print(f"{BMCContainer.LOG_TYPES[3]} No suitable files were found under '{args.src}' directory.")
+        return 1
+    
+    results = b_batch(src_files, args.dest, kape=args.kape, options=options, workers=max(1, args.workers), dedup=args.dedup, force=args.force, report=args.report, budget=args.triage_run, phash=args.phash)
+    return 0 if all(res["ok"] for res in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,449 +1,239 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import argparse
 import os
 import os.path
-import sys
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
-from struct import pack, unpack
 import threading
+from collections import OrderedDict, deque
 from queue import Queue
-import time
 
-class BMCContainer():
-    BIN_FILE_HEADER = b"RDP8bmp\x00"
-    BIN_CONTAINER = b".BIN"
-    BMC_CONTAINER = b".BMC"
-    TILE_HEADER_SIZE = {BMC_CONTAINER: 0x14, BIN_CONTAINER: 0xC}
-    STRIPE_WIDTH = 64
-    LOG_TYPES = ["[===]", "[+++]", "[---]", "[!!!]"]
+# The parsing core lives in bitmap_cache_parser (BMCContainer used to be
+# defined here and stays importable from this module)
+from bitmap_cache_parser import BMCContainer, b_batch, b_find_files
+
+class BMCTileCache:
+    """LRU cache of decoded tiles bounded by their total size in bytes"""
     
-    # Complete PALETTE definition from original code
-    PALETTE = bytes(bytearray((0, 0, 0, 0, 0, 0, 128, 0, 0, 128, 0, 0, 0, 128, 128, 0, 128, 0, 0, 0, 128, 0, 128, 0, 128, 128, 0, 0, 192, 192, 192, 0, 192, 220, 192, 0, 240, 202, 166, 0, 0, 32, 64, 0, 0, 32, 96, 0, 0, 32, 128, 0, 0, 32, 160, 0, 0, 32, 192, 0, 0, 32, 224, 0, 0, 64, 0, 0, 0, 64, 32, 0, 0, 64, 64, 0, 0, 64, 96, 0, 0, 64, 128, 0, 0, 64, 160, 0, 0, 64, 192, 0, 0, 64, 224, 0, 0, 96, 0, 0, 0, 96, 32, 0, 0, 96, 64, 0, 0, 96, 96, 0, 0, 96, 128, 0, 0, 96, 160, 0, 0, 96, 192, 0, 0, 96, 224, 0, 0, 128, 0, 0, 0, 128, 32, 0, 0, 128, 64, 0, 0, 128, 96, 0, 0, 128, 128, 0, 0, 128, 160, 0, 0, 128, 192, 0, 0, 128, 224, 0, 0, 160, 0, 0, 0, 160, 32, 0, 0, 160, 64, 0, 0, 160, 96, 0, 0, 160, 128, 0, 0, 160, 160, 0, 0, 160, 192, 0, 0, 160, 224, 0, 0, 192, 0, 0, 0, 192, 32, 0, 0, 192, 64, 0, 0, 192, 96, 0, 0, 192, 128, 0, 0, 192, 160, 0, 0, 192, 192, 0, 0, 192, 224, 0, 0, 224, 0, 0, 0, 224, 32, 0, 0, 224, 64, 0, 0, 224, 96, 0, 0, 224, 128, 0, 0, 224, 160, 0, 0, 224, 192, 0, 0, 224, 224, 0, 64, 0, 0, 0, 64, 0, 32, 0, 64, 0, 64, 0, 64, 0, 96, 0, 64, 0, 128, 0, 64, 0, 160, 0, 64, 0, 192, 0, 64, 0, 224, 0, 64, 32, 0, 0, 64, 32, 32, 0, 64, 32, 64, 0, 64, 32, 96, 0, 64, 32, 128, 0, 64, 32, 160, 0, 64, 32, 192, 0, 64, 32, 224, 0, 64, 64, 0, 0, 64, 64, 32, 0, 64, 64, 64, 0, 64, 64, 96, 0, 64, 64, 128, 0, 64, 64, 160, 0, 64, 64, 192, 0, 64, 64, 224, 0, 64, 96, 0, 0, 64, 96, 32, 0, 64, 96, 64, 0, 64, 96, 96, 0, 64, 96, 128, 0, 64, 96, 160, 0, 64, 96, 192, 0, 64, 96, 224, 0, 64, 128, 0, 0, 64, 128, 32, 0, 64, 128, 64, 0, 64, 128, 96, 0, 64, 128, 128, 0, 64, 128, 160, 0, 64, 128, 192, 0, 64, 128, 224, 0, 64, 160, 0, 0, 64, 160, 32, 0, 64, 160, 64, 0, 64, 160, 96, 0, 64, 160, 128, 0, 64, 160, 160, 0, 64, 160, 192, 0, 64, 160, 224, 0, 64, 192, 0, 0, 64, 192, 32, 0, 64, 192, 64, 0, 64, 192, 96, 0, 64, 192, 128, 0, 64, 192, 160, 0, 64, 192, 192, 0, 64, 192, 224, 0, 64, 224, 0, 0, 64, 224, 32, 0, 64, 224, 64, 0, 64, 224, 96, 0, 64, 224, 128, 0, 64, 224, 160, 0, 64, 224, 192, 0, 64, 224, 224, 0, 128, 0, 0, 0, 128, 0, 32, 0, 128, 0, 64, 0, 128, 0, 96, 0, 128, 0, 128, 0, 128, 0, 160, 0, 128, 0, 192, 0, 128, 0, 224, 0, 128, 32, 0, 0, 128, 32, 32, 0, 128, 32, 64, 0, 128, 32, 96, 0, 128, 32, 128, 0, 128, 32, 160, 0, 128, 32, 192, 0, 128, 32, 224, 0, 128, 64, 0, 0, 128, 64, 32, 0, 128, 64, 64, 0, 128, 64, 96, 0, 128, 64, 128, 0, 128, 64, 160, 0, 128, 64, 192, 0, 128, 64, 224, 0, 128, 96, 0, 0, 128, 96, 32, 0, 128, 96, 64, 0, 128, 96, 96, 0, 128, 96, 128, 0, 128, 96, 160, 0, 128, 96, 192, 0, 128, 96, 224, 0, 128, 128, 0, 0, 128, 128, 32, 0, 128, 128, 64, 0, 128, 128, 96, 0, 128, 128, 128, 0, 128, 128, 160, 0, 128, 128, 192, 0, 128, 128, 224, 0, 128, 160, 0, 0, 128, 160, 32, 0, 128, 160, 64, 0, 128, 160, 96, 0, 128, 160, 128, 0, 128, 160, 160, 0, 128, 160, 192, 0, 128, 160, 224, 0, 128, 192, 0, 0, 128, 192, 32, 0, 128, 192, 64, 0, 128, 192, 96, 0, 128, 192, 128, 0, 128, 192, 160, 0, 128, 192, 192, 0, 128, 192, 224, 0, 128, 224, 0, 0, 128, 224, 32, 0, 128, 224, 64, 0, 128, 224, 96, 0, 128, 224, 128, 0, 128, 224, 160, 0, 128, 224, 192, 0, 128, 224, 224, 0, 192, 0, 0, 0, 192, 0, 32, 0, 192, 0, 64, 0, 192, 0, 96, 0, 192, 0, 128, 0, 192, 0, 160, 0, 192, 0, 192, 0, 192, 0, 224, 0, 192, 32, 0, 0, 192, 32, 32, 0, 192, 32, 64, 0, 192, 32, 96, 0, 192, 32, 128, 0, 192, 32, 160, 0, 192, 32, 192, 0, 192, 32, 224, 0, 192, 64, 0, 0, 192, 64, 32, 0, 192, 64, 64, 0, 192, 64, 96, 0, 192, 64, 128, 0, 192, 64, 160, 0, 192, 64, 192, 0, 192, 64, 224, 0, 192, 96, 0, 0, 192, 96, 32, 0, 192, 96, 64, 0, 192, 96, 96, 0, 192, 96, 128, 0, 192, 96, 160, 0, 192, 96, 192, 0, 192, 96, 224, 0, 192, 128, 0, 0, 192, 128, 32, 0, 192, 128, 64, 0, 192, 128, 96, 0, 192, 128, 128, 0, 192, 128, 160, 0, 192, 128, 192, 0, 192, 128, 224, 0, 192, 160, 0, 0, 192, 160, 32, 0, 192, 160, 64, 0, 192, 160, 96, 0, 192, 160, 128, 0, 192, 160, 160, 0, 192, 160, 192, 0, 192, 160, 224, 0, 192, 192, 0, 0, 192, 192, 32, 0, 192, 192, 64, 0, 192, 192, 96, 0, 192, 192, 128, 0, 192, 192, 160, 0, 240, 251, 255, 0, 164, 160, 160, 0, 128, 128, 128, 0, 0, 0, 255, 0, 0, 255, 0, 0, 0, 255, 255, 0, 255, 0, 0, 0, 255, 0, 255, 0, 255, 255, 0, 0, 255, 255, 255, 0)))
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
     
-    COLOR_BLACK = b"\x00"
-    COLOR_WHITE = b"\xFF"
+    def __contains__(self, key):
+        return key in self.items
     
-    def __init__(self, verbose=False, count=0, old=False, big=False, width=64, log_callback=None):
-        self.bdat = ""
-        self.o_bmps = []
-        self.bmps = []
-        self.btype = None
-        self.cnt = count
-        self.fname = None
-        self.oldsave = old
-        self.pal = False
-        self.verb = verbose
-        self.big = big
-        self.STRIPE_WIDTH = width
-        self.log_callback = log_callback
-        
-        if count > 0:
-            self.b_log(True, 2, f"At most {count} tiles will be processed.")
-        if old:
-            self.b_log(True, 2, "Old data will also be saved in separate files.")
+    def __len__(self):
+        return len(self.items)
     
-    def b_log(self, verbose, ltype, lmsg):
-        if not verbose or self.verb:
-            log_message = f"{self.LOG_TYPES[ltype]} {lmsg}"
-            if self.log_callback:
-                self.log_callback(log_message)
-            else:
-                print(log_message)
-        return True
-
-    def b_import(self, fname):
-        """Import BMCache file - exact copy from original"""
-        if len(self.bdat) > 0:
-            self.b_log(False, 3, "Data is already waiting to be processed; aborting.")
-            return False
-        
-        try:
-            with open(fname, "rb") as f:
-                self.bdat = memoryview(f.read())
-        except Exception as e:
-            self.b_log(False, 3, f"Unable to retrieve file contents; aborting. Error: {str(e)}")
-            return False
-        
-        if len(self.bdat) == 0:
-            self.b_log(False, 3, "Unable to retrieve file contents; aborting.")
-            return False
-        
-        self.fname = fname
-        self.btype = self.BMC_CONTAINER
-        
-        if self.bdat[:len(self.BIN_FILE_HEADER)] == self.BIN_FILE_HEADER:
-            self.b_log(True, 2, f"Subsequent header version: {unpack('<L', self.bdat[len(self.BIN_FILE_HEADER):len(self.BIN_FILE_HEADER)+4])[0]}.")
-            self.bdat = self.bdat[len(self.BIN_FILE_HEADER)+4:]
-            self.btype = self.BIN_CONTAINER
-        
-        self.b_log(True, 0, f"Successfully loaded '{self.fname}' as a {self.btype.decode()} container.")
-        return True
-
-    def b_process(self):
-        """Process the imported BMCache data - exact copy from original"""
-        if len(self.bdat) == 0:
-            self.b_log(False, 3, "Nothing to process.")
-            return False
-        
-        bl = 0
-        while len(self.bdat) > 0:
-            old = False
-            o_bmp = ""
-            t_hdr = self.bdat[:self.TILE_HEADER_SIZE[self.btype]]
-            key1, key2, t_width, t_height = unpack("<LLHH", t_hdr[:0xC])
-            
-            if self.btype == self.BIN_CONTAINER:
-                bl = 4*t_width*t_height
-                t_bmp = self.b_parse_rgb32b(self.bdat[len(t_hdr):len(t_hdr)+bl].tobytes())
-            elif self.btype == self.BMC_CONTAINER:
-                t_bmp = ""
-                t_len, t_params = unpack("<LL", t_hdr[-0x8:])
-                if t_params & 0x08:  # Compression bit flag
-                    if bl == 0:
-                        if "22.bmc" in self.fname:
-                            bl = 64*64*2
-                        elif "24.bmc" in self.fname:
-                            bl = 64*64*4
-                        elif "2.bmc" in self.fname:
-                            bl = 64*64
-                        else:
-                            for b in [1, 2, 4]:
-                                if len(self.bdat) < len(t_hdr)+64*64*b+8:
-                                    break
-                                elif unpack("<H", self.bdat[len(t_hdr)+64*64*b+8:][:2])[0] == 64:
-                                    bl = 64*64*b
-                                    break
-                            if bl == 0:
-                                self.b_log(False, 3, "Unable to determine data pattern size; exiting before throwing any error!")
-                                return False
-                    o_bmp = b""
-                    t_bmp = self.b_uncompress(self.bdat[len(t_hdr):len(t_hdr)+t_len].tobytes(), bl//(64*64))
-                    if len(t_bmp) > 0:
-                        if len(t_bmp) != t_width*t_height*bl//(64*64):
-                            self.b_log(False, 3, f"Uncompressed tile data seems bogus (uncompressed {len(t_bmp)} bytes while expecting {t_width*t_height*bl//(64*64)}). Discarding tile.")
-                            t_bmp = b""
-                        else:
-                            t_bmp = self.b_parse_rgb565(t_bmp)
-                else:
-                    cf = t_len//(t_width*t_height)
-                    if cf == 4:
-                        t_bmp = self.b_parse_rgb32b(self.bdat[len(t_hdr):len(t_hdr)+cf*t_width*t_height].tobytes())
-                        if t_height != 64:
-                            old = True
-                            o_bmp = self.b_parse_rgb32b(self.bdat[len(t_hdr)+cf*t_width*t_height:len(t_hdr)+cf*64*64].tobytes())
-                    elif cf == 3:
-                        t_bmp = self.b_parse_rgb24b(self.bdat[len(t_hdr):len(t_hdr)+cf*t_width*t_height].tobytes())
-                        if t_height != 64:
-                            old = True
-                            o_bmp = self.b_parse_rgb24b(self.bdat[len(t_hdr)+cf*t_width*t_height:len(t_hdr)+cf*64*64].tobytes())
-                    elif cf == 2:
-                        t_bmp = self.b_parse_rgb565(self.bdat[len(t_hdr):len(t_hdr)+cf*t_width*t_height].tobytes())
-                        if t_height != 64:
-                            old = True
-                            o_bmp = self.b_parse_rgb565(self.bdat[len(t_hdr)+cf*t_width*t_height:len(t_hdr)+cf*64*64].tobytes())
-                    elif cf == 1:
-                        self.pal = True
-                        t_bmp = self.PALETTE+self.bdat[len(t_hdr):len(t_hdr)+cf*t_width*t_height].tobytes()
-                        if t_height != 64:
-                            old = True
-                            o_bmp = self.PALETTE+self.bdat[len(t_hdr)+cf*t_width*t_height:len(t_hdr)+cf*64*64].tobytes()
-                    else:
-                        self.b_log(False, 3, f"Unexpected bpp ({8*cf}) found during processing; aborting.")
-                        return False
-                    bl = cf*64*64
-            
-            if len(t_bmp) > 0:
-                self.bmps.append(t_bmp)
-                self.o_bmps.append(o_bmp)
-                if len(self.bmps)%100 == 0:
-                    self.b_log(True, 1, f"{len(self.bmps)} tiles successfully extracted so far.")
-            
-            self.bdat = self.bdat[len(t_hdr)+bl:]
-            if self.cnt != 0 and len(self.bmps) == self.cnt:
-                break
-        
-        self.b_log(False, 0, f"{len(self.bmps)} tiles successfully extracted in the end.")
-        return True
-
-    def b_parse_rgb565(self, data):
-        """Parse RGB565 data - exact copy from original"""
-        d_out = b""
-        while len(data) > 0:
-            pxl = unpack("<H", data[:2])[0]
-            bl = ((pxl>>8)&0xF8)|((pxl>>13)&0x07)
-            gr = ((pxl>>3)&0xFC)|((pxl>>9)&0x03)
-            re = ((pxl<<3)&0xF8)|((pxl>>2)&0x07)
-            d_out += bytearray((re, gr, bl, 255))
-            data = data[2:]
-        return bytes(d_out)
-
-    def b_parse_rgb32b(self, data):
-        """Parse RGB32 data - exact copy from original"""
-        d_out = b""
-        d_buf = b""
-        while len(data) > 0:
-            if self.btype == self.BIN_CONTAINER:
-                d_buf += data[:3]+b"\xFF"
-                if len(d_buf) == 256:
-                    d_out = d_buf+d_out
-                    d_buf = b""
-            else:
-                d_out += data[:3]+b"\xFF"
-            data = data[4:]
-        return d_out
+    def b_get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        self.items.move_to_end(key)
+        return item[0]
+    
+    def b_put(self, key, value, size):
+        if key in self.items:
+            self.size -= self.items.pop(key)[1]
+        self.items[key] = (value, size)
+        self.size += size
+        # Evict the least recently used tiles, always keeping the newest one
+        while self.size > self.max_bytes and len(self.items) > 1:
+            self.size -= self.items.popitem(last=False)[1][1]
 
-    def b_parse_rgb24b(self, data):
-        """Parse RGB24 data - exact copy from original"""
-        d_out = b""
-        d_buf = b""
-        while len(data) > 0:
-            if self.btype == self.BIN_CONTAINER:
-                d_buf += data[:3]+b"\xFF"
-                if len(d_buf) == 256:
-                    d_out = d_buf+d_out
-                    d_buf = b""
-            else:
-                d_out += data[:3]+b"\xFF"
-            data = data[3:]
-        return d_out
+# Palette index -> red, green and blue planes of the 8-bit tiles
+PALETTE_RGB = [bytes(BMCContainer.PALETTE[4*i+c] for i in range(256)) for c in (2, 1, 0)]
 
-    def b_unrle(self, data):
-        """RLE decompression helper - exact copy from original"""
-        if len(data) == 0:
-            return (-1, 1, 0)
-        x = ord(data[0:1])
-        if (x&0xF0) == 0xF0:
-            if x in [0xF5, 0xFB, 0xFC, 0xFF]:
-                return (-1, 2, x)
-            elif x in [0xFD, 0xFE]:
-                return (x, 0, 1)
-            elif x in [0xF9, 0xFA]:
-                return (x, 8, 1)
-            elif len(data) < 3:
-                return (-1, 1, 0)
-            else:
-                c = unpack("<H", data[1:3])[0]
-                return (x, c, 3)
-        elif (x&0xE0) == 0xA0:
-            return (-1, 2, x)
-        else:
-            if (x&0x80) == 0x00 or (x&0xE0) == 0x80:
-                c = x&0x1F
-                x = x&0xE0
-                o = 32
-            else:
-                c = x&0x0F
-                x = x&0xF0
-                o = 16
-            if x in [0x40, 0xD0]:
-                c *= 8
-                o = 1
-            if c == 0:
-                if len(data) < 2:
-                    return (-1, 1, 0)
-                else:
-                    c = ord(data[1:2])+o
-                o = 2
-            else:
-                o = 1
-            return (x, c, o)
-        return (-1, 3, 0)
+def b_tile_ppm(data):
+    """Binary PPM image (top-down RGB) of a tile in exported form, or None if it is empty"""
+    pal = BMCContainer.PALETTE
+    if len(data) > len(pal) and data[:len(pal)] == pal:
+        data = data[len(pal):]
+        height = len(data)//64
+        rows = [data[64*r:64*(r+1)] for r in range(height-1, -1, -1)]
+        idx = b"".join(rows)
+        planes = [idx.translate(table) for table in PALETTE_RGB]
+    else:
+        height = len(data)//256
+        rows = [data[256*r:256*(r+1)] for r in range(height-1, -1, -1)]
+        pixels = b"".join(rows)
+        planes = [pixels[c::4] for c in (2, 1, 0)]
+    if height == 0:
+        return None
+    rgb = bytearray(3*64*height)
+    for c, plane in enumerate(planes):
+        rgb[c::3] = plane
+    return b"P6 64 %d 255\n" % height + bytes(rgb)
 
-    def b_uncompress(self, data, bbp):
-        """Uncompress bitmap data - exact copy from original"""
-        d_out = b""
-        bro = -1
-        fgc = self.COLOR_WHITE*bbp
-        
-        while len(data) > 0:
-            cmd, rl, sz = self.b_unrle(data[:3])
-            if cmd == -1:
-                if rl == 1:
-                    self.b_log(False, 3, "Unexpected end of compressed stream. Skipping tile.")
-                elif rl == 2:
-                    self.b_log(False, 3, f"Unexpected decompression command encountered (0x{sz:02X}). Skipping tile.")
-                else:
-                    self.b_log(False, 3, "Unhandled case in decompression routine. Skipping tile.")
-                return b""
-            
-            data = data[sz:]
-            
-            if cmd in [0x00, 0xF0]:
-                if len(d_out) < 64*bbp:
-                    if bro == 0:
-                        d_out += fgc
-                        rl -= 1
-                    d_out += (self.COLOR_BLACK*bbp)*rl
-                else:
-                    if bro > 0:
-                        c = d_out[-64*bbp:][:bbp]
-                        for i in range(bbp):
-                            d_out += bytearray((ord(c[i:i+1])^ord(fgc[i:i+1]), ))
-                        rl -= 1
-                    while rl > 0:
-                        d_out += d_out[-64*bbp:][:bbp]
-                        rl -= 1
-                bro = len(d_out)//(64*bbp)
-            elif cmd in [0x20, 0xC0, 0xF1, 0xF6]:
-                if cmd in [0xC0, 0xF6]:
-                    if len(data) < bbp:
-                        self.b_log(False, 3, "Unexpected end of compressed stream. Skipping tile.")
-                        return b""
-                    fgc = data[:bbp]
-                    data = data[bbp:]
-                if len(d_out) < 64*bbp:
-                    d_out += fgc*rl
-                else:
-                    while rl > 0:
-                        c = d_out[-64*bbp:][:bbp]
-                        for i in range(bbp):
-                            d_out += bytearray((ord(c[i:i+1])^ord(fgc[i:i+1]), ))
-                        rl -= 1
-            elif cmd in [0xE0, 0xF8]:
-                if len(data) < 2*bbp:
-                    self.b_log(False, 3, "Unexpected end of compressed stream. Skipping tile.")
-                    return b""
-                d_out += data[:2*bbp]*rl
-                data = data[2*bbp:]
-            elif cmd in [0x60, 0xF3]:
-                if len(data) < bbp:
-                    self.b_log(False, 3, "Unexpected end of compressed stream. Skipping tile.")
-                    return b""
-                d_out += data[:bbp]*rl
-                data = data[bbp:]
-            elif cmd in [0x40, 0xD0, 0xF2, 0xF7, 0xF9, 0xFA]:
-                if cmd in [0xD0, 0xF7]:
-                    if len(data) < bbp:
-                        self.b_log(False, 3, "Unexpected end of compressed stream. Skipping tile.")
-                        return b""
-                    fgc = data[:bbp]
-                    data = data[bbp:]
-                if cmd == 0xF9:
-                    msk = b"\x03"
-                    ml = 1
-                elif cmd == 0xFA:
-                    msk = b"\x05"
-                    ml = 1
-                else:
-                    if (rl%8) != 0:
-                        ml = (rl//8)+1
-                    else:
-                        ml = rl//8
-                    if len(data) < ml:
-                        self.b_log(False, 3, "Unexpected end of compressed stream. Skipping tile.")
-                        return b""
-                    msk = data[:ml]
-                    data = data[ml:]
-                k = 0
-                while rl > 0:
-                    if (k%8) == 0:
-                        m = ord(msk[k//8:][:1])
-                    b = m&(0x1<<(k%8))
-                    if len(d_out) < 64*bbp:
-                        if b == 0:
-                            d_out += (self.COLOR_BLACK*bbp)
-                        else:
-                            d_out += fgc
-                    else:
-                        c = d_out[-64*bbp:][:bbp]
-                        if b == 0:
-                            d_out += c
-                        else:
-                            for i in range(bbp):
-                                d_out += bytearray((ord(c[i:i+1])^ord(fgc[i:i+1]), ))
-                    k += 1
-                    rl -= 1
-            elif cmd in [0x80, 0xF4]:
-                if len(data) < bbp*rl:
-                    self.b_log(False, 3, "Unexpected end of compressed stream. Skipping tile.")
-                    return b""
-                d_out += data[:rl*bbp]
-                data = data[rl*bbp:]
-            elif cmd == 0xFD:
-                d_out += (self.COLOR_WHITE*bbp)
-            elif cmd == 0xFE:
-                d_out += (self.COLOR_BLACK*bbp)
-            else:
-                self.b_log(False, 3, f"Unhandled decompression command (0x{cmd:02X}). Skipping tile.")
-                return b""
-            if cmd not in [0x00, 0xF0]:
-                bro = -1
-        return d_out
-
-    def b_export(self, dname):
-        """Export processed bitmaps - exact copy from original"""
-        if not os.path.isdir(dname):
-            self.b_log(False, 3, "Destination must be an already existing folder.")
+class BMCGallery:
+    """Thumbnail gallery of the tiles of one cache file
+    
+    Only the tiles scrolled into view are decoded, by a background thread
+    reading the memory-mapped file through its tile index. Decoded images
+    go into an LRU cache of CACHE_BYTES, and the canvas items of the grid
+    are a fixed pool of cells moved and refilled while scrolling, so the
+    window stays responsive whatever the number of tiles.
+    """
+    TILE = 64
+    PAD = 8
+    LABEL = 14
+    CACHE_BYTES = 64 << 20
+    POLL_INTERVAL = 50
+    
+    def __init__(self, root, fname, log_callback=None):
+        self.window = tk.Toplevel(root)
+        self.window.title(f"Tiles - {os.path.basename(fname)}")
+        self.window.geometry("760x600")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        self.fname = fname
+        self.log_callback = log_callback
+        # Parser messages of the decode thread are handed over to the UI thread by poll
+        self.bmcc = BMCContainer(log_callback=lambda msg: self.results.put(("log", None, msg)), use_mmap=True)
+        self.cache = BMCTileCache(self.CACHE_BYTES)
+        self.ntiles = 0
+        self.cols = 1
+        self.cells = []
+        self.placeholder = tk.PhotoImage(width=self.TILE, height=self.TILE)
+        self.status_var = tk.StringVar(value="Indexing tiles...")
+        
+        # Shared with the decode thread: the tiles wanted on screen, newest request first
+        self.lock = threading.Lock()
+        self.wanted = []
+        self.wake = threading.Event()
+        self.results = Queue()
+        self.closed = False
+        
+        self.canvas = tk.Canvas(self.window, background="#303030", highlightthickness=0,
+                                yscrollincrement=self.cell_size()[1])
+        scrollbar = ttk.Scrollbar(self.window, orient=tk.VERTICAL, command=self.scroll)
+        self.canvas.configure(yscrollcommand=scrollbar.set)
+        ttk.Label(self.window, textvariable=self.status_var).pack(side=tk.BOTTOM, fill=tk.X)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.canvas.bind("<Configure>", lambda e: self.layout())
+        self.canvas.bind("<MouseWheel>", lambda e: self.scroll("scroll", -e.delta//120, "units"))
+        self.canvas.bind("<Button-4>", lambda e: self.scroll("scroll", -1, "units"))
+        self.canvas.bind("<Button-5>", lambda e: self.scroll("scroll", 1, "units"))
+        
+        self.thread = threading.Thread(target=self.decode_loop, daemon=True)
+        self.thread.start()
+        self.poll()
+    
+    def cell_size(self):
+        return self.TILE+self.PAD, self.TILE+self.PAD+self.LABEL
+    
+    def index_tiles(self):
+        """Tile index of the file: the sidecar if it is current, else a header scan (the evidence folder is never written to)"""
+        if not self.bmcc.b_import(self.fname):
             return False
-        
-        fname_base = os.path.basename(self.fname)
-        for i in range(len(self.bmps)):
-            self.b_write(os.path.join(dname, f"{fname_base}_{i:04d}.bmp"), 
-                        self.b_export_bmp(64, len(self.bmps[i])//256, self.bmps[i]))
-            if self.oldsave and i < len(self.o_bmps) and len(self.o_bmps[i]) > 0:
-                self.b_write(os.path.join(dname, f"{fname_base}_old_{i:04d}.bmp"), 
-                            self.b_export_bmp(64, len(self.o_bmps[i])//256, self.o_bmps[i]))
-        
-        self.b_log(False, 0, f"Successfully exported {len(self.bmps)} files.")
-        
-        if self.big:
-            pad = b"\xFF"
-            if not self.pal:
-                pad *= 4
-            for i in range(len(self.bmps)):
-                if self.pal:
-                    self.bmps[i] = self.bmps[i][len(self.PALETTE):]
-                while len(self.bmps[i]) < 64*64*len(pad):
-                    self.bmps[i] += pad*64
-            
-            w = 64*len(self.bmps)
-            h = 64
-            if len(self.bmps)//self.STRIPE_WIDTH > 0:
-                m = len(self.bmps)%self.STRIPE_WIDTH
-                if m != 0:
-                    for i in range(self.STRIPE_WIDTH-m):
-                        self.bmps.append(pad*64*64)
-                w = self.STRIPE_WIDTH*64
-                h *= len(self.bmps)//self.STRIPE_WIDTH
-            
-            c_bmp = b"" if not self.pal else self.PALETTE
-            if self.btype == self.BIN_CONTAINER:
-                collage_builder = (lambda x, a=self, PAD=len(pad), WIDTH=range(w // 64): b''.join([b''.join([a.bmps[a.STRIPE_WIDTH*(x+1)-1-k][64*PAD*j:64*PAD*(j+1)] for k in WIDTH]) for j in range(64)]))
+        return self.bmcc.b_index()
+    
+    def decode_loop(self):
+        """Background thread: index the file, then decode the wanted tiles into PPM images"""
+        ok = self.index_tiles()
+        self.results.put(("indexed", len(self.bmcc.tindex) if ok else -1, None))
+        while not self.closed:
+            self.wake.wait()
+            with self.lock:
+                if not self.wanted:
+                    self.wake.clear()
+                    continue
+                i = self.wanted.pop(0)
+            try:
+                tile = self.bmcc.b_decode_tile(i)
+                ppm = b_tile_ppm(tile.data) if tile is not None else None
+            except Exception as e:
+                ppm = None
+                self.results.put(("error", i, str(e)))
+            self.results.put(("tile", i, ppm))
+        self.bmcc.b_flush()
+    
+    def poll(self):
+        """Turn the decoded tiles into images on the UI thread and show those still in view"""
+        if self.closed:
+            return
+        shown = False
+        while not self.results.empty():
+            kind, i, ppm = self.results.get_nowait()
+            if kind == "indexed":
+                self.ntiles = max(0, i)
+                self.status_var.set(f"{self.ntiles} tiles" if i >= 0 else "Unable to index the tiles of this file.")
+                self.layout()
+            elif kind in ["log", "error"]:
+                message = ppm if kind == "log" else f"[!!!] Tile {i} of '{self.fname}': {ppm}"
+                self.status_var.set(message)
+                if self.log_callback:
+                    self.log_callback(message)
             else:
-                collage_builder = (lambda x, a=self, PAD=len(pad), WIDTH=range(w // 64): b''.join([b''.join([a.bmps[a.STRIPE_WIDTH*x+k][64*PAD*j:64*PAD*(j+1)] for k in WIDTH]) for j in range(64)]))
-            
-            c_bmp += b''.join(map(collage_builder, range(h//64)))
-            self.b_write(os.path.join(dname, f"{fname_base}_collage.bmp"), 
-                        self.b_export_bmp(w, h, c_bmp))
-            self.b_log(False, 0, "Successfully exported collage file.")
-        
-        return True
-
-    def b_export_bmp(self, width, height, data):
-        """Export BMP format - exact copy from original"""
-        if not self.pal:
-            return b"BM"+pack("<L", len(data)+122)+b"\x00\x00\x00\x00\x7A\x00\x00\x00\x6C\x00\x00\x00"+pack("<L", width)+pack("<L", height)+b"\x01\x00\x20\x00\x03\x00\x00\x00"+pack("<L", len(data))+b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xFF\x00\x00\xFF\x00\x00\xFF\x00\x00\x00\x00\x00\x00\xFF niW"+(b"\x00"*36)+b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"+data
-        else:
-            return b"BM"+pack("<L", len(data)+0x36)+b"\x00\x00\x00\x00\x36\x04\x00\x00\x28\x00\x00\x00"+pack("<L", width)+pack("<L", height)+b"\x01\x00\x08\x00\x00\x00\x00\x00"+pack("<L", len(data)-0x400)+b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"+data
-
-    def b_write(self, fname, data):
-        """Write file - exact copy from original"""
-        with open(fname, "wb") as f:
-            f.write(data)
-        return True
-
-    def b_flush(self):
-        """Clear processed data - exact copy from original"""
-        self.bdat = ""
-        self.bmps = []
-        self.o_bmps = []
-        return True
+                image = tk.PhotoImage(data=ppm, format="PPM") if ppm else self.placeholder
+                self.cache.b_put(i, image, len(ppm) if ppm else 0)
+                shown = True
+        if shown:
+            self.refresh()
+        self.window.after(self.POLL_INTERVAL, self.poll)
+    
+    def layout(self):
+        """Size the virtual grid to the window and rebuild the cell pool when the visible grid changes"""
+        cw, ch = self.cell_size()
+        width = max(self.canvas.winfo_width(), cw)
+        cols = max(1, width//cw)
+        rows = (self.ntiles+cols-1)//cols
+        self.canvas.configure(scrollregion=(0, 0, cols*cw, rows*ch))
+        # One more row than fits, as the top and bottom rows are usually cut
+        ncells = cols*(self.canvas.winfo_height()//ch+2)
+        if cols != self.cols or ncells != len(self.cells):
+            self.cols = cols
+            for image, label in self.cells:
+                self.canvas.delete(image)
+                self.canvas.delete(label)
+            self.cells = [(self.canvas.create_image(0, 0, anchor=tk.NW, image=self.placeholder),
+                           self.canvas.create_text(0, 0, anchor=tk.N, fill="#D0D0D0", font=('Consolas', 8)))
+                          for _ in range(ncells)]
+        self.refresh()
+    
+    def scroll(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+    
+    def refresh(self):
+        """Assign the tiles in view to the cells, queueing the missing ones for decoding"""
+        cw, ch = self.cell_size()
+        first = int(self.canvas.canvasy(0))//ch*self.cols
+        missing = []
+        for n, (image, label) in enumerate(self.cells):
+            i = first+n
+            if i >= self.ntiles:
+                self.canvas.itemconfigure(image, state=tk.HIDDEN)
+                self.canvas.itemconfigure(label, state=tk.HIDDEN)
+                continue
+            x, y = i%self.cols*cw+self.PAD//2, i//self.cols*ch+self.PAD//2
+            photo = self.cache.b_get(i)
+            if photo is None:
+                missing.append(i)
+            self.canvas.coords(image, x, y+self.TILE-(photo or self.placeholder).height())
+            self.canvas.itemconfigure(image, image=photo or self.placeholder, state=tk.NORMAL)
+            self.canvas.coords(label, x+self.TILE//2, y+self.TILE+1)
+            self.canvas.itemconfigure(label, text=f"{i:04d}", state=tk.NORMAL)
+        # Tiles scrolled out of view before being decoded are dropped from the queue
+        with self.lock:
+            self.wanted = missing
+        if missing:
+            self.wake.set()
+    
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.window.destroy()
 
-# GUI Code remains exactly the same as before
 class BMCacheParserGUI:
+    # The log widget keeps the last LOG_MAX_LINES lines and is refreshed every
+    # LOG_INTERVAL ms; the full log goes to LOG_FILE in the destination folder
+    LOG_MAX_LINES = 5000
+    LOG_INTERVAL = 100
+    LOG_FILE = "bitmap_cache_parser.log"
+    
     def __init__(self, root):
         self.root = root
         self.root.title("RDP Bitmap Cache Parser")
@@ -463,6 +253,16 @@ class BMCacheParserGUI:
         self.bitmap_var = tk.BooleanVar(value=False)
         self.width_var = tk.IntVar(value=64)
         self.kape_var = tk.BooleanVar(value=False)
+        self.workers_var = tk.IntVar(value=1)
+        self.dedup_var = tk.BooleanVar(value=False)
+        self.force_var = tk.BooleanVar(value=False)
+        self.format_var = tk.StringVar(value="bmp")
+        self.logfile_var = tk.BooleanVar(value=True)
+        self.uniform_var = tk.BooleanVar(value=False)
+        self.stitch_var = tk.BooleanVar(value=False)
+        self.log_file = None
+        # The log file is written by the processing thread and by gallery threads
+        self.log_lock = threading.Lock()
         
         self.processing = False
         self.log_queue = Queue()
@@ -540,6 +340,33 @@ class BMCacheParserGUI:
                                 textvariable=self.width_var, width=10)
         width_spin.grid(row=1, column=1, sticky=tk.W, padx=(5, 0), pady=2)
         
+        # Workers option
+        ttk.Label(options_frame, text="Worker processes:").grid(
+            row=4, column=0, sticky=tk.W, pady=2)
+        workers_spin = ttk.Spinbox(options_frame, from_=1, to=os.cpu_count() or 1, 
+                                  textvariable=self.workers_var, width=10)
+        workers_spin.grid(row=4, column=1, sticky=tk.W, padx=(5, 0), pady=2)
+        ttk.Label(options_frame, text="(files processed in parallel)").grid(
+            row=4, column=2, sticky=tk.W, padx=(5, 0), pady=2)
+        
+        ttk.Checkbutton(options_frame, text="Deduplicate identical tiles (manifest)", 
+                       variable=self.dedup_var).grid(row=5, column=0, sticky=tk.W, pady=2)
+        ttk.Checkbutton(options_frame, text="Reprocess unchanged files", 
+                       variable=self.force_var).grid(row=5, column=1, sticky=tk.W, pady=2)
+        
+        # Output format option
+        ttk.Label(options_frame, text="Output format:").grid(
+            row=6, column=0, sticky=tk.W, pady=2)
+        ttk.Combobox(options_frame, textvariable=self.format_var, state="readonly",
+                     values=sorted(BMCContainer.SINKS), width=8).grid(
+            row=6, column=1, sticky=tk.W, padx=(5, 0), pady=2)
+        ttk.Checkbutton(options_frame, text="Save full log to destination", 
+                       variable=self.logfile_var).grid(row=6, column=2, sticky=tk.W, pady=2)
+        ttk.Checkbutton(options_frame, text="Skip blank / solid-colour tiles", 
+                       variable=self.uniform_var).grid(row=7, column=0, sticky=tk.W, pady=2)
+        ttk.Checkbutton(options_frame, text="Stitch tiles into screen mosaics", 
+                       variable=self.stitch_var).grid(row=7, column=1, sticky=tk.W, pady=2)
+        
         # Checkboxes
         ttk.Checkbutton(options_frame, text="Verbose output", 
                        variable=self.verbose_var).grid(row=2, column=0, sticky=tk.W, pady=2)
@@ -577,6 +404,9 @@ class BMCacheParserGUI:
                                      state='disabled')
         self.stop_button.pack(side=tk.LEFT, padx=5)
         
+        ttk.Button(button_frame, text="Browse Tiles", 
+                  command=self.open_gallery).pack(side=tk.LEFT, padx=5)
+        
         ttk.Button(button_frame, text="Clear Log", 
                   command=self.clear_log).pack(side=tk.LEFT, padx=5)
         
@@ -620,21 +450,43 @@ class BMCacheParserGUI:
         if folder:
             self.dest_path.set(folder)
     
+    def open_gallery(self):
+        """Open a thumbnail gallery of the selected cache file (or of a file picked now)"""
+        source = self.source_path.get()
+        if not os.path.isfile(source):
+            source = filedialog.askopenfilename(
+                title="Select BMCache file to browse",
+                filetypes=[("BMCache files", "*.bmc *.bin"), ("All files", "*.*")]
+            )
+        if source:
+            BMCGallery(self.root, source, log_callback=self.gallery_log)
+    
+    def gallery_log(self, message):
+        self.log_message(message)
+        # The log is only refreshed periodically while processing
+        if not self.processing:
+            self.update_log()
+    
     def log_message(self, message):
+        with self.log_lock:
+            if self.log_file:
+                self.log_file.write(message + "\n")
         self.log_queue.put(message)
     
     def update_log(self):
-        try:
-            while True:
-                message = self.log_queue.get_nowait()
-                self.log_text.insert(tk.END, message + "\n")
-                self.log_text.see(tk.END)
-                self.root.update_idletasks()
-        except:
-            pass
+        """Move every queued message to the log widget in one insert, keeping only its last LOG_MAX_LINES lines"""
+        lines = deque(maxlen=self.LOG_MAX_LINES)
+        while not self.log_queue.empty():
+            lines.append(self.log_queue.get_nowait())
+        if lines:
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - self.LOG_MAX_LINES
+            if excess > 0:
+                self.log_text.delete("1.0", f"{excess + 1}.0")
+            self.log_text.see(tk.END)
         
         if self.processing:
-            self.root.after(100, self.update_log)
+            self.root.after(self.LOG_INTERVAL, self.update_log)
     
     def clear_log(self):
         self.log_text.delete(1.0, tk.END)
@@ -685,67 +537,59 @@ class BMCacheParserGUI:
     
     def process_files(self):
         try:
-            # Create BMCContainer with GUI callback
-            bmcc = BMCContainer(
+            if self.logfile_var.get():
+                log_file = open(os.path.join(self.dest_path.get(), self.LOG_FILE), "a", encoding="utf-8")
+                with self.log_lock:
+                    self.log_file = log_file
+            options = dict(
                 verbose=self.verbose_var.get(),
                 count=self.count_var.get() if self.count_var.get() > 0 else 0,
                 old=self.old_var.get(),
                 big=self.bitmap_var.get(),
                 width=self.width_var.get(),
-                log_callback=self.log_message
+                fmt=self.format_var.get(),
+                skip_uniform=self.uniform_var.get(),
+                stitch=self.stitch_var.get()
             )
             
-            src_files = []
             source = self.source_path.get()
             
             if os.path.isdir(source):
                 self.log_message("[+++] Processing a directory...")
-                for root, dirs, files in os.walk(source):
-                    for f in files:
-                        if f.rsplit(".", 1)[-1].upper() in ["BIN", "BMC"]:
-                            file_path = os.path.join(root, f)
-                            if self.verbose_var.get():
-                                self.log_message(f"[---] File '{file_path}' has been found.")
-                            src_files.append(file_path)
+                src_files = b_find_files(source)
+                if self.verbose_var.get():
+                    for file_path in src_files:
+                        self.log_message(f"[---] File '{file_path}' has been found.")
                 
                 if len(src_files) == 0:
                     self.log_message(f"No suitable files were found under '{source}' directory.")
                     return
             else:
                 self.log_message(f"[+++] Processing a single file: '{source}'.")
-                src_files.append(source)
+                src_files = [source]
             
-            total_files = len(src_files)
-            for i, src in enumerate(src_files):
-                if not self.processing:
-                    break
-                
-                self.progress_var.set(f"Processing file {i+1}/{total_files}: {os.path.basename(src)}")
-                self.log_message(f"[+++] Processing file: '{src}'")
-                
-                if bmcc.b_import(src):
-                    destination = self.dest_path.get()
-                    
-                    if self.kape_var.get():
-                        destination = src.replace("\\", "_").replace("//", "_").replace(":", "_")
-                        destination = destination.replace("_AppData_Local_Microsoft_Terminal Server Client_Cache", "")
-                        destination = os.path.join(self.dest_path.get(), destination)
-                        if not os.path.exists(destination):
-                            os.makedirs(destination)
-                    
-                    bmcc.b_process()
-                    bmcc.b_export(destination)
-                    bmcc.b_flush()
+            b_batch(src_files, self.dest_path.get(), kape=self.kape_var.get(), options=options,
+                    workers=max(1, self.workers_var.get()), log_callback=self.log_message,
+                    progress=self.file_done, stop=lambda: not self.processing,
+                    dedup="hash" if self.dedup_var.get() else None, force=self.force_var.get())
             
             self.log_message("[===] Processing completed successfully!")
             
         except Exception as e:
             self.log_message(f"[!!!] Error during processing: {str(e)}")
         finally:
+            with self.log_lock:
+                if self.log_file:
+                    self.log_file.close()
+                    self.log_file = None
             self.root.after(0, self.processing_finished)
     
+    def file_done(self, done, total, res):
+        self.progress_var.set(f"Processed file {done}/{total}: {os.path.basename(res['file'])}")
+    
     def processing_finished(self):
         self.processing = False
+        self.update_log()
         self.process_button.config(state='normal')
         self.stop_button.config(state='disabled')
         self.progress_var.set("Completed")
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import sys
+import json
+import time
+from array import array
+from bisect import bisect_left
+from struct import pack, unpack_from
+
+from bitmap_cache_parser import BMCContainer
+
+# Palette index -> green channel, the grey level used for 8-bit tiles
+PALETTE_GREY = bytes(BMCContainer.PALETTE[4*i+1] for i in range(256))
+
+def b_phash(grey, width, height):
+    """64-bit perceptual hash of a grey plane (one byte per pixel, rows of width bytes)
+
+    The image is reduced to the mean of each cell of an 8x8 grid, and bit k
+    tells whether cell k is brighter than the next one (gradient hash), so
+    the hash survives small colour, scaling and compression changes.
+    """
+    cells = []
+    for gy in range(8):
+        y0 = gy*height//8
+        y1 = max(y0+1, (gy+1)*height//8)
+        for gx in range(8):
+            x0 = gx*width//8
+            x1 = max(x0+1, (gx+1)*width//8)
+            cells.append(sum(sum(grey[y*width+x0:y*width+x1]) for y in range(y0, min(y1, height)))/((x1-x0)*(y1-y0)))
+    h = 0
+    for k in range(64):
+        if cells[k] > cells[(k+1)%64]:
+            h |= 1<<k
+    return h
+
+def b_tile_phash(data):
+    """Perceptual hash of an exported tile: 32-bit pixels, or 8-bit indexes after the palette"""
+    pal = len(BMCContainer.PALETTE)
+    if len(data) > pal and (len(data)-pal)%64 == 0 and data[:pal] == BMCContainer.PALETTE:
+        grey = data[pal:].translate(PALETTE_GREY)
+    else:
+        grey = data[1::4]
+    if len(grey) < 64:
+        return None
+    return b_phash(grey, 64, len(grey)//64)
+
+def b_collect_phashes(tiles, phashes):
+    """Streaming stage appending (tile number, hash) to phashes for every tile, passing the tiles on"""
+    for tile in tiles:
+        h = b_tile_phash(tile.data)
+        if h is not None:
+            phashes.append((tile.index, h))
+        yield tile
+
+def b_bmp_phash(fname):
+    """Perceptual hash of an uncompressed 8, 24 or 32-bit BMP file, e.g. a tile of interest"""
+    with open(fname, "rb") as f:
+        data = f.read()
+    if data[:2] != b"BM":
+        raise ValueError(f"'{fname}' is not a BMP file.")
+    off, hsize, width, height, planes, bpp = unpack_from("<LLllHH", data, 10)
+    stride = (width*bpp//8+3)&~3
+    # The 8-bit tiles exported by the parser understate their height: trust the pixel data size
+    nrows = max(abs(height), (len(data)-off)//stride) if stride else 0
+    rows = [data[off+stride*r:off+stride*r+width*bpp//8] for r in range(nrows)]
+    if height < 0:
+        # Top-down bitmap: bring it in the bottom-up order of the exported tiles
+        rows.reverse()
+    if bpp == 8:
+        palette = data[14+hsize:off]
+        grey = bytes(palette[4*i+1] if 4*i+1 < len(palette) else 0 for i in range(256))
+        plane = b"".join(rows).translate(grey)
+    elif bpp in [24, 32]:
+        plane = b"".join(row[1::bpp//8] for row in rows)
+    else:
+        raise ValueError(f"Unsupported BMP depth ({bpp} bits) in '{fname}'.")
+    return b_phash(plane, width, nrows)
+
+def b_hamming(a, b):
+    return bin(a^b).count("1")
+
+class BMCPhashIndex():
+    """Persistent perceptual-hash index of the tiles of many cache files
+
+    Every tile is a record (hash, source file, tile number). Queries use
+    multi-index hashing: the 64-bit hashes are cut into PARTS substrings,
+    each kept in a sorted table, and a hash within distance k of a query
+    shares at least one substring within distance k//PARTS with it, so only
+    the few records found by probing those substrings are compared.
+    """
+    MAGIC = b"BMCPHX1\x00"
+    PARTS = 4
+    BITS = 64//PARTS
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.hashes = array("Q")
+        self.srcs = array("I")
+        self.tiles = array("I")
+        self.sources = []
+        self.source_ids = {}
+        # Per part: sorted (substring << 32 | record) keys, rebuilt when stale
+        self.tables = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def b_load(self):
+        """Read the index file, if there is one"""
+        try:
+            with open(self.fname, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        if data[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"'{self.fname}' is not a perceptual-hash index.")
+        n, tables, slen = unpack_from("<QLQ", data, len(self.MAGIC))
+        p = len(self.MAGIC)+20
+        arrays = [self.hashes, self.srcs, self.tiles]
+        if tables:
+            self.tables = [array("Q") for part in range(self.PARTS)]
+            arrays += self.tables
+        for arr in arrays:
+            arr.frombytes(data[p:p+n*arr.itemsize])
+            p += n*arr.itemsize
+        self.sources = json.loads(data[p:p+slen].decode("utf-8"))
+        self.source_ids = {src: i for i, src in enumerate(self.sources)}
+        return True
+
+    def b_save(self, tables=True):
+        """Atomically rewrite the index file, with the query tables unless tables is False (they are then rebuilt on load)"""
+        arrays = [self.hashes, self.srcs, self.tiles]
+        if tables:
+            arrays += self.b_tables()
+        sources = json.dumps(self.sources).encode("utf-8")
+        with open(self.fname+".tmp", "wb") as f:
+            f.write(self.MAGIC+pack("<QLQ", len(self.hashes), int(tables), len(sources)))
+            for arr in arrays:
+                arr.tofile(f)
+            f.write(sources)
+        os.replace(self.fname+".tmp", self.fname)
+        return True
+
+    def b_add(self, source, hashes):
+        """Add the (tile number, hash) pairs of one cache file, replacing what was indexed for it"""
+        src = self.source_ids.get(source)
+        if src is None:
+            src = self.source_ids[source] = len(self.sources)
+            self.sources.append(source)
+        elif src in self.srcs:
+            keep = [i for i in range(len(self.srcs)) if self.srcs[i] != src]
+            self.hashes, self.srcs, self.tiles = (array(a.typecode, (a[i] for i in keep)) for a in (self.hashes, self.srcs, self.tiles))
+        for tile, h in hashes:
+            self.hashes.append(h)
+            self.srcs.append(src)
+            self.tiles.append(tile)
+        self.tables = None
+        return True
+
+    def b_tables(self):
+        mask = (1<<self.BITS)-1
+        if self.tables is None:
+            self.tables = [array("Q", sorted((((h>>(self.BITS*part))&mask)<<32)|i for i, h in enumerate(self.hashes)))
+                           for part in range(self.PARTS)]
+        return self.tables
+
+    def b_query(self, h, k=4):
+        """Records within Hamming distance k of hash h: sorted (distance, source, tile number) tuples"""
+        mask = (1<<self.BITS)-1
+        radius = k//self.PARTS
+        found = set()
+        for part, table in enumerate(self.b_tables()):
+            sub = (h>>(self.BITS*part))&mask
+            for probe in self.b_neighbours(sub, radius):
+                i = bisect_left(table, probe<<32)
+                while i < len(table) and table[i]>>32 == probe:
+                    found.add(table[i]&0xFFFFFFFF)
+                    i += 1
+        res = []
+        for i in found:
+            d = b_hamming(h, self.hashes[i])
+            if d <= k:
+                res.append((d, self.sources[self.srcs[i]], self.tiles[i]))
+        res.sort()
+        return res
+
+    def b_neighbours(self, sub, radius):
+        """Every BITS-bit value within Hamming distance radius of sub"""
+        probes = {sub}
+        for r in range(radius):
+            probes |= {p^(1<<b) for p in probes for b in range(self.BITS)}
+        return probes
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Search a perceptual-hash index of cache tiles for tiles of interest.")
+    parser.add_argument("index", help="Index file built with 'bitmap_cache_parser.py --phash'.")
+    parser.add_argument("references", nargs="+", help="BMP files of the tiles of interest.")
+    parser.add_argument("-k", "--distance", type=int, default=6, help="Maximum Hamming distance of a match (default=6).")
+    args = parser.parse_args(argv)
+
+    index = BMCPhashIndex(args.index)
+    if not index.b_load():
+        print(f"{BMCContainer.LOG_TYPES[3]} No index found at '{args.index}'.")
+        return 1
+    print(f"{BMCContainer.LOG_TYPES[0]} {len(index)} tiles from {len(index.sources)} files indexed.")
+    index.b_tables()
+    for ref in args.references:
+        t0 = time.perf_counter()
+        matches = index.b_query(b_bmp_phash(ref), args.distance)
+        print(f"{BMCContainer.LOG_TYPES[1]} '{ref}': {len(matches)} match(es) in {1000*(time.perf_counter()-t0):.1f} ms.")
+        for d, source, tile in matches:
+            print(f"    {d:2d}  {os.path.basename(source)}_{tile:04d}.bmp  ({source})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
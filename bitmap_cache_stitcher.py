@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import tempfile
+from collections import deque
+from itertools import product
+
+from bitmap_cache_parser import BMCContainer
+
+class BMCStitcher():
+    """Reassemble decoded 64x64 tiles into screen mosaics by matching their borders
+
+    RDP tiles do not overlap: the facing borders of two neighbours are two
+    different pixel lines, only close to each other on continuous content.
+    Each border is compared with the line extrapolated from the last two
+    lines of the other tile (the seam cost is the mean difference of both
+    comparisons). Candidates are not compared with every other tile but
+    looked up in hash indexes of a tolerant border signature, the means of
+    SEGMENTS segments quantized by STEP, probing the neighbouring buckets of
+    the means closest to a quantization step. Two tiles are linked when
+    each is the clear best match of the other; near-uniform borders carry
+    no information and are ignored. Linked tiles are laid out on a grid,
+    one mosaic per connected group of at least min_tiles tiles.
+
+    Tile data is in exported form: bottom-up rows of 32-bit pixels, or 8-bit
+    palette tiles which are expanded. Other tiles are left out. Only the
+    border lines of each tile are kept in memory; the tiles themselves are
+    spooled to a temporary file until the mosaics are written.
+    """
+    TILE = 64
+    ROW = 4*TILE
+    # Low bits of each colour channel are ignored when telling uniform borders
+    QUANT = bytes(x&0xF8 for x in range(256))
+    PAD = b"\xFF"*4
+    SEGMENTS = 8
+    STEP = 32
+    MAX_PROBES = 16
+    # Buckets holding more borders than this are too common to tell anything
+    MAX_BUCKET = 64
+    # Largest mean seam cost (per colour channel) of a link
+    MAX_COST = 6.0
+
+    def __init__(self, min_tiles=4):
+        self.min_tiles = min_tiles
+        self.spool = tempfile.TemporaryFile()
+        self.recs = []
+        # Border lines of each spooled tile: (top, bottom, left, right), each an (outer, beyond) pair
+        self.edges = []
+        self.placed = 0
+        self.palette = None
+
+    def __len__(self):
+        return len(self.recs)
+
+    def b_collect(self, tiles):
+        """Streaming stage adding every suitable tile to the stitcher, passing the tiles on"""
+        for tile in tiles:
+            data = self.b_pixels(tile.data)
+            if data is not None:
+                self.recs.append((self.spool.tell(), len(tile.data)))
+                self.spool.write(tile.data)
+                self.edges.append(self.b_edges(data))
+            yield tile
+
+    def b_tile(self, i):
+        """32-bit pixels of the i-th spooled tile"""
+        off, size = self.recs[i]
+        self.spool.seek(off)
+        return self.b_pixels(self.spool.read(size))
+
+    def b_close(self):
+        self.spool.close()
+        return True
+
+    def b_pixels(self, data):
+        """32-bit pixels of a full exported tile, or None if the tile cannot be stitched"""
+        n = self.TILE*self.TILE
+        if len(data) == 4*n:
+            return data
+        if len(data) == len(BMCContainer.PALETTE)+n and data[:len(BMCContainer.PALETTE)] == BMCContainer.PALETTE:
+            if self.palette is None:
+                pal = BMCContainer.PALETTE
+                self.palette = [pal[4*i:4*i+3]+b"\xFF" for i in range(256)]
+            return b"".join(map(self.palette.__getitem__, data[len(BMCContainer.PALETTE):]))
+        return None
+
+    def b_edges(self, data):
+        """(top, bottom, left, right) borders of a tile, top being its last stored row
+
+        Each border is its outer line and the line extrapolated just beyond
+        it from the outer and inner lines; a line is stored as its blue,
+        green and red planes.
+        """
+        row = self.ROW
+        line_row = lambda r: b"".join(data[row*r+c:row*(r+1):4] for c in range(3))
+        line_col = lambda x: b"".join(data[4*x+c::row] for c in range(3))
+        last = self.TILE-1
+        return tuple(self.b_extrapolate(outer, inner) for outer, inner in
+                     ((line_row(last), line_row(last-1)), (line_row(0), line_row(1)),
+                      (line_col(0), line_col(1)), (line_col(last), line_col(last-1))))
+
+    def b_extrapolate(self, outer, inner):
+        """(outer, beyond) lines of a border, beyond being the line expected just past it"""
+        return outer, bytes(min(255, max(0, 2*o-i)) for o, i in zip(outer, inner))
+
+    def b_informative(self, line):
+        line = line.translate(self.QUANT)
+        return line.count(line[:1]) != len(line)
+
+    def b_segments(self, line):
+        """Mean level of each of the SEGMENTS segments of a line, all planes together"""
+        n = self.TILE//self.SEGMENTS
+        planes = range(0, len(line), self.TILE)
+        return [sum(sum(line[p+n*s:p+n*(s+1)]) for p in planes)/(n*len(planes)) for s in range(self.SEGMENTS)]
+
+    def b_key(self, line):
+        return tuple(int(v//self.STEP) for v in self.b_segments(line))
+
+    def b_probes(self, line):
+        """Signature of a line and of its variants across the nearest quantization steps"""
+        means = self.b_segments(line)
+        key = [int(v//self.STEP) for v in means]
+        # Segments sorted by the distance of their mean to the closest step
+        near = []
+        for s, v in enumerate(means):
+            frac = v/self.STEP-key[s]
+            near.append((min(frac, 1-frac), s, -1 if frac < 0.5 else 1))
+        near.sort()
+        flips = [(s, d) for dist, s, d in near[:self.MAX_PROBES.bit_length()-1] if dist < 0.25]
+        for chosen in product([False, True], repeat=len(flips)):
+            probe = list(key)
+            for (s, d), flip in zip(flips, chosen):
+                if flip:
+                    probe[s] += d
+            yield tuple(probe)
+
+    def b_cost(self, a, b):
+        """Seam cost between border a of one tile and the facing border b of another
+
+        Mean difference between each outer line and the line extrapolated
+        from the other side.
+        """
+        diff = sum(abs(x-y) for x, y in zip(b[0], a[1]))+sum(abs(x-y) for x, y in zip(a[0], b[1]))
+        return diff/(2*len(a[0]))
+
+    def b_bound(self, a, b):
+        """Lower bound of b_cost from the segment means of the lines (a and b as returned by b_segments)"""
+        diff = sum(abs(x-y) for x, y in zip(b[0], a[1]))+sum(abs(x-y) for x, y in zip(a[0], b[1]))
+        return diff/(2*self.SEGMENTS)
+
+    def b_links(self):
+        """Mutual clear best border matches: (right neighbours, lower neighbours) as tile -> tile dicts"""
+        links = []
+        # Right border of a tile against left borders, bottom border against top borders
+        for a, b in ((3, 2), (1, 0)):
+            index = {}
+            segments = {}
+            for i, edges in enumerate(self.edges):
+                if self.b_informative(edges[b][0]):
+                    index.setdefault(self.b_key(edges[b][0]), []).append(i)
+                    segments[i] = tuple(map(self.b_segments, edges[b]))
+            best_a, best_b = {}, {}
+            for i, edges in enumerate(self.edges):
+                if not self.b_informative(edges[a][0]):
+                    continue
+                candidates = set()
+                for probe in self.b_probes(edges[a][1]):
+                    bucket = index.get(probe, [])
+                    if len(bucket) <= self.MAX_BUCKET:
+                        candidates.update(bucket)
+                candidates.discard(i)
+                seg_a = tuple(map(self.b_segments, edges[a]))
+                for j in candidates:
+                    if self.b_bound(seg_a, segments[j]) > self.MAX_COST:
+                        continue
+                    cost = self.b_cost(edges[a], self.edges[j][b])
+                    if cost <= self.MAX_COST:
+                        self.b_rank(best_a, i, j, cost)
+                        self.b_rank(best_b, j, i, cost)
+            pairs = {}
+            for i, (cost, j, second) in best_a.items():
+                if best_b[j][1] == i and self.b_clear(cost, second) and self.b_clear(cost, best_b[j][2]):
+                    pairs[i] = j
+            links.append(pairs)
+        return links
+
+    def b_rank(self, best, i, j, cost):
+        """Keep (cost, match, cost of the runner-up) of the best match j of i"""
+        first = best.get(i)
+        if first is None:
+            best[i] = (cost, j, None)
+        elif cost < first[0]:
+            best[i] = (cost, j, first[0])
+        elif first[2] is None or cost < first[2]:
+            best[i] = (first[0], first[1], cost)
+        return True
+
+    def b_clear(self, cost, second):
+        """Tell whether a best match stands out enough from the runner-up"""
+        return second is None or second-cost >= 1.0+cost/2
+
+    def b_layouts(self):
+        """Grid layouts {(x, y): tile} of the linked groups, largest first; y grows downwards"""
+        right, below = self.b_links()
+        adjacency = {}
+        for pairs, dx, dy in ((right, 1, 0), (below, 0, 1)):
+            for a, b in pairs.items():
+                adjacency.setdefault(a, []).append((b, dx, dy))
+                adjacency.setdefault(b, []).append((a, -dx, -dy))
+        placed = set()
+        layouts = []
+        for start in adjacency:
+            if start in placed:
+                continue
+            grid = {(0, 0): start}
+            placed.add(start)
+            queue = deque([(start, 0, 0)])
+            while queue:
+                tile, x, y = queue.popleft()
+                for other, dx, dy in adjacency[tile]:
+                    if other in placed or (x+dx, y+dy) in grid:
+                        continue
+                    grid[(x+dx, y+dy)] = other
+                    placed.add(other)
+                    queue.append((other, x+dx, y+dy))
+            if len(grid) >= self.min_tiles:
+                layouts.append(grid)
+        layouts.sort(key=len, reverse=True)
+        self.placed = sum(len(grid) for grid in layouts)
+        return layouts
+
+    def b_mosaics(self):
+        """Yield (width, height, chunks) for each mosaic, chunks streaming its bottom-up pixel rows"""
+        for grid in self.b_layouts():
+            xs = [x for x, y in grid]
+            ys = [y for x, y in grid]
+            x0, y0 = min(xs), min(ys)
+            cols, rows = max(xs)-x0+1, max(ys)-y0+1
+            yield self.TILE*cols, self.TILE*rows, self.b_bands(grid, x0, y0, cols, rows)
+
+    def b_bands(self, grid, x0, y0, cols, rows):
+        """Pixel data of a mosaic, one band of tiles at a time from the bottom one"""
+        row = self.ROW
+        blank = self.PAD*self.TILE
+        for y in range(y0+rows-1, y0-1, -1):
+            band = [self.b_tile(grid[(x, y)]) if (x, y) in grid else None for x in range(x0, x0+cols)]
+            yield b"".join([data[row*r:row*(r+1)] if data is not None else blank for r in range(self.TILE) for data in band])
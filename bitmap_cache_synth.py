@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import sys
+import math
+import random
+from struct import pack
+
+# Compressed BMC containers are recognised by these file names (see BMCContainer.b_walk_headers)
+COMPRESSED_NAMES = {8: "bcache2.bmc", 16: "bcache22.bmc", 32: "bcache24.bmc"}
+
+def b_synth_pixels(rnd, npx, cf, noise):
+    """npx pixels of cf bytes: random noise with probability noise, else one flat colour"""
+    if rnd.random() < noise:
+        return rnd.randbytes(npx*cf)
+    return rnd.randbytes(cf)*npx
+
+def b_synth_rle(rnd, npx, cf):
+    """An RLE interleaved stream decoding to exactly npx pixels of cf bytes, using every common order"""
+    out = []
+    left = npx
+    while left > 0:
+        k = rnd.randrange(8)
+        if k == 0:
+            n = min(left, rnd.randint(1, 31))
+            out.append(bytes([0x80|n])+rnd.randbytes(n*cf))  # Copy
+        elif k == 1:
+            n = min(left, rnd.randint(1, 31))
+            out.append(bytes([0x60|n])+rnd.randbytes(cf))  # Colour run
+        elif k == 2 and left >= 2:
+            n = min(left//2, rnd.randint(1, 15))
+            out.append(bytes([0xE0|n])+rnd.randbytes(2*cf))  # Dithered run
+            n *= 2
+        elif k == 3:
+            n = min(left, rnd.randint(1, 31))
+            out.append(bytes([0x00|n]))  # Background run
+        elif k == 4:
+            n = min(left, rnd.randint(1, 31))
+            out.append(bytes([0x20|n]))  # Foreground run
+        elif k == 5 and left >= 8:
+            c = min(left//8, rnd.randint(1, 3))
+            n = 8*c
+            out.append(bytes([0x40|c])+rnd.randbytes(c))  # Foreground/background image
+        elif k == 6:
+            n = min(left, rnd.randint(1, 15))
+            out.append(bytes([0xC0|n])+rnd.randbytes(cf))  # Set foreground run
+        else:
+            n = 1
+            out.append(rnd.choice([b"\xFD", b"\xFE"]))  # White / black
+        left -= n
+    return b"".join(out)
+
+def b_synth_bmc(ntiles, bpp=32, compressed=False, old=0.0, noise=0.5, seed=0):
+    """Build a .bmc container of ntiles 64-pixel wide tiles
+
+    bpp is 8, 16, 24 or 32 (compressed: 8, 16 or 32). A share old of the
+    uncompressed tiles is shorter than 64 lines, leaving old data in the
+    rest of its slot.
+    """
+    rnd = random.Random(seed)
+    cf = bpp//8
+    bl = 64*64*cf
+    out = []
+    for i in range(ntiles):
+        key1, key2 = rnd.getrandbits(32), rnd.getrandbits(32)
+        if compressed:
+            h = 64
+            while True:
+                data = b_synth_rle(rnd, 64*h, cf)
+                if len(data) <= bl:
+                    break
+            out.append(pack("<LLHHLL", key1, key2, 64, h, len(data), 0x08)+data+b"\x00"*(bl-len(data)))
+        else:
+            h = rnd.randint(1, 63) if rnd.random() < old else 64
+            out.append(pack("<LLHHLL", key1, key2, 64, h, cf*64*h, 0)+b_synth_pixels(rnd, 64*h, cf, noise)+rnd.randbytes(bl-cf*64*h))
+    return b"".join(out)
+
+def b_synth_bin(ntiles, old=0.0, noise=0.5, seed=0, version=6):
+    """Build an RDP8bmp .bin container of ntiles 32-bit tiles, a share old of them shorter than 64 lines"""
+    rnd = random.Random(seed)
+    out = [b"RDP8bmp\x00"+pack("<L", version)]
+    for i in range(ntiles):
+        h = rnd.randint(1, 63) if rnd.random() < old else 64
+        out.append(pack("<LLHH", rnd.getrandbits(32), rnd.getrandbits(32), 64, h)+b_synth_pixels(rnd, 64*h, 4, noise))
+    return b"".join(out)
+
+def b_synth_screen_pixel(pattern, x, y, stripes, dots):
+    """BGRA pixel of a synthetic screen at (x, y), y growing downwards"""
+    if pattern == "stripes":
+        # Horizontal stripes 6 pixels high, shaded along x
+        b, g, r = stripes[y//6]
+        shade = x//16
+        return bytes((b, (g+shade)&0xFF, r, 0xFF))
+    b = int(127+120*math.sin(x/150+y/230))
+    g = int(127+120*math.sin(y/110-x/300+1))
+    r = int(127+120*math.cos((x+2*y)/260))
+    if pattern == "dots" and (x, y) in dots:
+        return b"\x00\x00\x00\xFF"
+    return bytes((b, g, r, 0xFF))
+
+def b_synth_screen(cols, rows, pattern="gradient", seed=0):
+    """A screen of cols x rows tiles cut into non-overlapping 64x64 tiles, stored shuffled in a .bmc container
+
+    pattern is one of SCREEN_PATTERNS. Returns (container, screen), screen
+    being the bottom-up 32-bit pixels of the whole screen, to check the
+    mosaics of the stitcher against.
+    """
+    rnd = random.Random(seed)
+    width, height = 64*cols, 64*rows
+    stripes = [(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for _ in range(height//6+1)]
+    dots = {(rnd.randrange(width), rnd.randrange(height)) for _ in range(width*height//200)}
+    lines = [b"".join(b_synth_screen_pixel(pattern, x, y, stripes, dots) for x in range(width)) for y in range(height)]
+    tiles = []
+    for ty in range(rows):
+        for tx in range(cols):
+            tiles.append(b"".join(lines[64*ty+63-r][256*tx:256*(tx+1)] for r in range(64)))
+    rnd.shuffle(tiles)
+    container = b"".join(pack("<LLHHLL", rnd.getrandbits(32), rnd.getrandbits(32), 64, 64, len(t), 0)+t for t in tiles)
+    return container, b"".join(reversed(lines))
+
+SCREEN_PATTERNS = ["gradient", "stripes", "dots"]
+
+def b_synth_corpus(dname, ntiles=200, old=0.2, noise=0.5, seed=0):
+    """Write one container of every kind to dname, returning their paths"""
+    files = {}
+    for bpp in [8, 16, 24, 32]:
+        files[f"raw{bpp:02d}.bmc"] = b_synth_bmc(ntiles, bpp, False, old, noise, seed+bpp)
+    for bpp, name in COMPRESSED_NAMES.items():
+        files[name] = b_synth_bmc(ntiles, bpp, True, 0.0, noise, seed+100+bpp)
+    files["Cache0000.bin"] = b_synth_bin(ntiles, old, noise, seed+200)
+    os.makedirs(dname, exist_ok=True)
+    paths = []
+    for name, data in files.items():
+        paths.append(os.path.join(dname, name))
+        with open(paths[-1], "wb") as f:
+            f.write(data)
+    return paths
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Synthetic RDP Bitmap Cache generator.")
+    parser.add_argument("-d", "--dest", required=True, help="Directory where to write the containers.")
+    parser.add_argument("-n", "--tiles", type=int, default=200, help="Number of tiles per container (default=200).")
+    parser.add_argument("--old", type=float, default=0.2, help="Share of uncompressed tiles carrying old data (default=0.2).")
+    parser.add_argument("--noise", type=float, default=0.5, help="Share of noise tiles, the others being flat (default=0.5).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed; the same seed gives the same files (default=0).")
+    parser.add_argument("--screen", choices=SCREEN_PATTERNS, help="Write a screen cut into shuffled tiles (screen_<pattern>.bmc) instead, for the stitcher.")
+    parser.add_argument("--cols", type=int, default=8, help="Screen width in tiles (default=8).")
+    parser.add_argument("--rows", type=int, default=5, help="Screen height in tiles (default=5).")
+    args = parser.parse_args(argv)
+    if args.screen:
+        container, screen = b_synth_screen(args.cols, args.rows, args.screen, args.seed)
+        path = os.path.join(args.dest, f"screen_{args.screen}.bmc")
+        os.makedirs(args.dest, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(container)
+        print(f"[+++] {path} ({args.cols*args.rows} tiles of a {64*args.cols}x{64*args.rows} screen)")
+        return 0
+    for path in b_synth_corpus(args.dest, args.tiles, args.old, args.noise, args.seed):
+        print(f"[+++] {path} ({os.path.getsize(path)} bytes)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,15 @@
+import os
+import os.path
+import sys
+
+import pytest
+
+# The modules are scripts at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitmap_cache_synth import b_synth_corpus
+
+@pytest.fixture(scope="session")
+def corpus(tmp_path_factory):
+    """One small synthetic container of every kind; the reference digests in test_decoding depend on these settings"""
+    return b_synth_corpus(str(tmp_path_factory.mktemp("corpus")), ntiles=40, old=0.3, seed=1)
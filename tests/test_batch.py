@@ -0,0 +1,58 @@
+import json
+import os
+import os.path
+from struct import pack
+
+from bitmap_cache_parser import BMCDedup, BMCRunManifest, b_batch, b_kape_destination
+
+def b_repeated_keys(path, ntiles=10):
+    """A 32-bit container whose second half reuses the cache keys of its first half, with distinct pixels"""
+    with open(path, "wb") as f:
+        for i in range(ntiles):
+            key = i%(ntiles//2)
+            f.write(pack("<LLHHLL", key+1, key+1, 64, 64, 4*64*64, 0)+bytes([i])*(4*64*64))
+    return path
+
+def b_bitmaps(dname):
+    return sorted(name for name in os.listdir(dname) if name.endswith(".bmp"))
+
+def test_triage_does_not_satisfy_full_run(tmp_path):
+    src = b_repeated_keys(str(tmp_path/"bcache24.bmc"))
+    dest = tmp_path/"out"
+    dest.mkdir()
+    quiet = lambda msg: None
+    res = b_batch([src], str(dest), options={"budget": 100}, log_callback=quiet)
+    # Repeated keys are skipped without being exported, yet the file is fully covered
+    assert res[0]["coverage"]["ratio"] == 1.0 and res[0]["tiles"] == 5
+    res = b_batch([src], str(dest), log_callback=quiet)
+    assert len(res) == 1 and res[0]["tiles"] == 10
+    assert len(b_bitmaps(str(dest))) == 10
+    # The full run is recorded: an unchanged file is now skipped by full runs
+    assert b_batch([src], str(dest), log_callback=quiet) == []
+
+def test_partial_triage_not_recorded(tmp_path):
+    src = b_repeated_keys(str(tmp_path/"bcache24.bmc"))
+    dest = tmp_path/"out"
+    dest.mkdir()
+    res = b_batch([src], str(dest), options={"budget": 1e-9}, log_callback=lambda msg: None)
+    assert res[0]["coverage"]["ratio"] < 1.0
+    processed = BMCRunManifest(str(dest))
+    processed.b_load()
+    assert processed.files == {}
+
+def test_corrupt_manifests(tmp_path):
+    src = b_repeated_keys(str(tmp_path/"bcache24.bmc"))
+    dest = tmp_path/"out"
+    dest.mkdir()
+    for name in [BMCDedup.MANIFEST, BMCRunManifest.MANIFEST]:
+        (dest/name).write_text('{"tiles": {"ab')
+    res = b_batch([src], str(dest), dedup="hash", log_callback=lambda msg: None)
+    assert res[0]["ok"]
+    with open(dest/BMCDedup.MANIFEST) as f:
+        assert len(json.load(f)["tiles"]) == 10
+
+def test_kape_destination_stays_inside(tmp_path):
+    dest = str(tmp_path)
+    for src in ["/cases/host/Cache0000.bin", "../cases/Cache0000.bin", "C:\\Users\\u\\AppData\\Local\\Microsoft\\Terminal Server Client\\Cache\\Cache0000.bin"]:
+        path = b_kape_destination(src, dest)
+        assert os.path.commonpath([dest, path]) == dest and path != dest, src
@@ -0,0 +1,88 @@
+import hashlib
+import os.path
+
+import pytest
+
+from bitmap_cache_parser import BMCContainer
+from bitmap_cache_bench import b_run, b_outputs
+
+# Digest of the bitmaps (tiles, old data and 8-wide collage) written for each
+# corpus file by the original implementation, with their count
+REFERENCE = {
+    "raw08.bmc": ("ce04dd85268406b67b13c557cf4e249d81ec7799a63bfef1a9e1f8577f670aa8", 49),
+    "raw16.bmc": ("f1bddb01e43af388a050ba180ae3dbf10ca16dbab0efc84ae545598b4e79504e", 52),
+    "raw24.bmc": ("4e150e513a96a452461e6b7c447f94f0aa14679ddcd592b77e27296cdd38a9f0", 51),
+    "raw32.bmc": ("98dbe986ff658c55afcff35ee4de1f32ed3d92b24b05eafdc11cecee632e31f2", 50),
+    "bcache2.bmc": ("42c38b6922b17126e17e90f88475d3a3732f2f4ea354abfaadbcc2124f8bbea4", 41),
+    "bcache22.bmc": ("d88dcc827a42679bd94188f652a195e420d17f0bda9612bf08e27e553c0ee3c4", 41),
+    "bcache24.bmc": ("5acac436fe8293c4de7609b9c493ffc6b7ddb68ae4809d2c86fb3a2816181527", 41),
+    "Cache0000.bin": ("36316c4c1d9b24180fca1a509035f6f8f0a3473bd259673d56df613ab75c66e3", 41),
+}
+
+def b_digest(outputs):
+    h = hashlib.sha256()
+    for name in sorted(outputs):
+        h.update(name.encode()+b"\0"+hashlib.sha256(outputs[name]).digest())
+    return h.hexdigest(), len(outputs)
+
+def b_container(logs=None):
+    return BMCContainer(log_callback=(logs if logs is not None else []).append)
+
+def test_reference_outputs(corpus, tmp_path):
+    for src in corpus:
+        out = tmp_path/os.path.basename(src)
+        out.mkdir()
+        assert b_run(BMCContainer(old=True, big=True, width=8, log_callback=lambda msg: None), src, str(out), False)
+        assert b_digest(b_outputs(str(out))) == REFERENCE[os.path.basename(src)], src
+
+ROW = 64  # pixels per scanline of a compressed tile
+
+@pytest.mark.parametrize("stream, expected", [
+    (b"\x83\x01\x02\x03", b"\x01\x02\x03"),             # Copy
+    (b"\x65\x07", b"\x07"*5),                          # Colour run
+    (b"\xE2\x01\x02", b"\x01\x02"*2),                  # Dithered run
+    (b"\xFD\xFE", b"\xFF\x00"),                        # White, black
+    (b"\x03", b"\x00"*3),                              # Background run on the first line
+    (b"\x22", b"\xFF"*2),                              # Foreground run, white by default
+    (b"\xC2\x09", b"\x09"*2),                          # Foreground run with a new colour
+    (b"\xC2\x09\x41\x05", b"\x09"*2+b"\x09\x00\x09"+b"\x00"*5),  # Mix run of 8 pixels, mask bits taken LSB first
+    (b"\x00\x22", b"\x00"*(ROW+2)),                    # Extended background run (length byte+32)
+])
+def test_rle_first_line(stream, expected):
+    assert b_container().b_uncompress(stream, 1) == expected
+
+def test_rle_next_lines():
+    bmcc = b_container()
+    first = b"\x60\x20\x0F"  # 64 pixels of 0x0F (extended colour run)
+    # A background run copies the line above, a foreground run XORs it with the foreground colour
+    assert bmcc.b_uncompress(first+b"\x02", 1) == b"\x0F"*(ROW+2)
+    assert bmcc.b_uncompress(first+b"\xC2\xF0", 1) == b"\x0F"*ROW+b"\xFF"*2
+    # Two background runs in a row: the second one starts with a foreground pixel
+    assert bmcc.b_uncompress(first+b"\x01\x01", 1) == b"\x0F"*(ROW+1)+b"\xF0"
+
+def test_rle_multibyte_pixels():
+    assert b_container().b_uncompress(b"\x62\x34\x12\xFD", 2) == b"\x34\x12"*2+b"\xFF\xFF"
+
+def test_rle_truncated_stream():
+    logs = []
+    assert b_container(logs).b_uncompress(b"\x83\x01", 1) == b""
+    assert any("Unexpected end" in msg for msg in logs)
+
+def test_rgb565():
+    bmcc = b_container()
+    assert bmcc.b_parse_rgb565(b"\x00\xF8\xE0\x07\x1F\x00\xFF\xFF") == b"\x00\x00\xFF\xFF"+b"\x00\xFF\x00\xFF"+b"\xFF\x00\x00\xFF"+b"\xFF"*4
+
+def test_rgb24_rgb32():
+    bmcc = b_container()
+    assert bmcc.b_parse_rgb24b(b"\x01\x02\x03\x04\x05\x06") == b"\x01\x02\x03\xFF\x04\x05\x06\xFF"
+    assert bmcc.b_parse_rgb32b(b"\x01\x02\x03\x04") == b"\x01\x02\x03\xFF"
+
+def test_bin_rows_reversed():
+    bmcc = b_container()
+    bmcc.btype = BMCContainer.BIN_CONTAINER
+    rows = [bytes([r])*256 for r in range(3)]
+    assert bmcc.b_parse_rgb32b(b"".join(rows)) == b"".join(bytes([r, r, r, 0xFF])*64 for r in (2, 1, 0))
+
+def test_palette_tiles():
+    bmcc = b_container()
+    assert bmcc.b_convert(1, b"\x00\x05") == BMCContainer.PALETTE+b"\x00\x05"